@@ -6,6 +6,7 @@ from .company import *
 from .payroll import *
 from .attendance import *
 from .configuration import *
+from .instrument import *
 
       
 def register():
@@ -22,18 +23,30 @@ def register():
       PayrollYear,
       PayrollPeriod,
       PayrollHoliday,
+      GenerateCalendarStart,
       AttendanceSummary,
+      Punctuality,
       LeaveApplication,
+      LeaveLedger,
       PaymentDetail,
       Party,
       Property,
       Date,
       EmployeeConfigStart,
+      ReorganizeStart,
+      ReorganizeLine,
       LeaveConfiguration,
+      LeavePolicy,
       EmployeeHistory,
+      EmployeeRevision,
+      EmployeeClosure,
       Attendance,
+      AttendanceImport,
       Rule,
+      InstrumentStats,
       module='hr', type_='model')
     Pool.register(
         EmployeeConfig,
+        GenerateCalendar,
+        Reorganize,
         module='hr', type_='wizard')      
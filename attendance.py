@@ -3,20 +3,163 @@
 # :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
 # :license: BSD, see LICENSE for more details.
 
+import csv
+import datetime
+from collections import defaultdict
 from datetime import timedelta
-from trytond.model import ModelView, ModelSQL, Workflow, fields
+from decimal import Decimal
+from io import BytesIO
+from dateutil.relativedelta import relativedelta
+from sql import Column, Literal, Null
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
+from trytond import backend
+from trytond.filestore import filestore
+from trytond.model import ModelView, ModelSQL, Workflow, fields, Unique
 from trytond.pool import Pool
 from trytond.pyson import Eval
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+from .instrument import Instrumented
 
-__all__ = ['Attendance', 'AttendanceSummary', 'LeaveApplication', ]
+__all__ = ['Attendance', 'AttendanceImport', 'AttendanceSummary', 'Punctuality', 'LeaveApplication', 'LeaveLedger', ]
+
+LEAVE_TYPE = [('casual', 'Casual Leave'), ('Sick', 'Sick Leave'), ('earned', 'earned Leave'), ('study', 'Study Leave'),
+              ('paternity', 'Paternity Leave'), ('annual', 'Annual Leave')]
+
+
+# Margin of the attendance summary refresh watermark
+REFRESH_OVERLAP = timedelta(minutes=10)
 
 
 def daterange(start_date, end_date):
-    for n in range(int((end_date - start_date).days)):
+    "Yield the days from start date to end date, both included"
+    for n in range(int((end_date - start_date).days) + 1):
         yield start_date + timedelta(n)
 
 
-class Attendance(ModelSQL, ModelView):
+# Punch log import pipeline, each stage yields (line number, values, error)
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_time(field, text):
+    """Parse the text of a punch as the value of the date or datetime field"""
+    text = text.strip()
+    if not text:
+        return None
+    for format_ in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            value = datetime.datetime.strptime(text, format_)
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError('invalid time "%s"' % text)
+    if field._type == 'date':
+        return value.date()
+    return value
+
+
+def open_punches(import_):
+    """Open the punch file of the import, from the file store when possible"""
+    field = import_.__class__.data
+    if import_.data_id and hasattr(filestore, '_filename'):
+        prefix = getattr(field, 'store_prefix', None) or Transaction().database.name
+        return open(filestore._filename(import_.data_id, prefix), 'rb')
+    return BytesIO(import_.data or b'')
+
+
+def read_punches(file_, start_line=0):
+    """Yield the rows of the punch file: badge, in time[, out time]"""
+    for number, row in enumerate(csv.reader(file_), 1):
+        if number <= start_line or not row or row[0].strip().lower() == 'badge':
+            continue
+        yield number, row
+
+
+def format_rejects(errors):
+    """Return the CSV lines of the rejected (line number, error)"""
+    rejects = BytesIO()
+    csv.writer(rejects).writerows(errors)
+    return rejects.getvalue()
+
+
+def parse_punches(rows, fields_):
+    for number, row in rows:
+        try:
+            in_time = parse_time(fields_['in_time'], row[1])
+            out_time = parse_time(fields_['out_time'], row[2]) if len(row) > 2 else None
+        except (IndexError, ValueError) as exception:
+            yield number, None, 'Invalid line: %s' % exception
+            continue
+        if not in_time:
+            yield number, None, 'Missing in time'
+            continue
+        date = in_time.date() if isinstance(in_time, datetime.datetime) else in_time
+        yield number, {'badge': row[0].strip(), 'date': date, 'in_time': in_time, 'out_time': out_time,
+                       'on_leave': False}, None
+
+
+def map_badges(items, index):
+    """Replace the badge by the employee found in the index of employee ids"""
+    for number, values, error in items:
+        if not error:
+            badge = values.pop('badge')
+            values['employee'] = index.get(badge)
+            if values['employee'] is None:
+                error = 'Unknown badge "%s"' % badge
+        yield number, values, error
+
+
+def deduplicate_punches(items, size):
+    """Reject punches of a day already in the chunk or in the database"""
+    Attendance = Pool().get('employee.attendance')
+    attendance = Attendance.__table__()
+    cursor = Transaction().connection.cursor()
+    for chunk in chunked(items, size):
+        keys = set((v['employee'], v['date']) for _, v, e in chunk if not e)
+        existing = set()
+        if keys:
+            dates = [k[1] for k in keys]
+            for sub_ids in grouped_slice(list(set(k[0] for k in keys))):
+                cursor.execute(*attendance.select(attendance.employee, attendance.date,
+                        where=reduce_ids(attendance.employee, sub_ids)
+                        & (attendance.date >= min(dates))
+                        & (attendance.date <= max(dates))))
+                existing.update(cursor.fetchall())
+        for number, values, error in chunk:
+            if not error:
+                key = (values['employee'], values['date'])
+                if key in existing:
+                    error = 'Duplicate attendance on %s' % values['date']
+                existing.add(key)
+            yield number, values, error
+
+
+def validate_punches(items, Attendance):
+    """Check the punches against the constraints of the attendance"""
+    for number, values, error in items:
+        if not error:
+            record = Attendance(**values)
+            for method, message in Attendance._constraints:
+                if not getattr(record, method)():
+                    error = Attendance._error_messages.get(message, message)
+                    break
+        yield number, values, error
+
+
+class Attendance(Instrumented, ModelSQL, ModelView):
     """Attendance"""
 
     @classmethod
@@ -27,13 +170,13 @@ class Attendance(ModelSQL, ModelView):
     employee = fields.Many2One('company.employee', 'Employee', required=True, select=True)
     date = fields.Date('Date', required=True, states={'invisible': Eval('on_leave') == 'True', }, depends=['on_leave'],
                        select=True)
-    period = fields.Function(fields.Many2One('payroll.period', 'Period', depends=['date']), 'get_period')
-    is_holiday = fields.Function(fields.Boolean('Is a Holiday ?', depends=['date']), 'get_is_holiday', )
+    period = fields.Function(fields.Many2One('payroll.period', 'Period', depends=['date']), 'get_period',
+                             searcher='search_period')
+    is_holiday = fields.Function(fields.Boolean('Is a Holiday ?', depends=['date']), 'get_is_holiday',
+                                 searcher='search_is_holiday')
 
-    # Make these fields as Time fields which seems to be broken somehow
-    # changed from datetime to date!Amine T
-    in_time = fields.Date('In time', states={'invisible': Eval('on_leave') != 'True', }, depends=['on_leave'])
-    out_time = fields.Date('Out time', states={'invisible': Eval('on_leave') != 'True', }, depends=['on_leave'])
+    in_time = fields.DateTime('In time', states={'invisible': Eval('on_leave') != 'True', }, depends=['on_leave'])
+    out_time = fields.DateTime('Out time', states={'invisible': Eval('on_leave') != 'True', }, depends=['on_leave'])
     on_leave = fields.Boolean('On Leave')
     leave_application = fields.Many2One('employee.leave.application', 'Leave Application',
                                         states={'invisible': Eval('on_leave') == 'True',
@@ -44,6 +187,30 @@ class Attendance(ModelSQL, ModelView):
         date2 = Pool().get('ir.date')
         return date2.today()
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+        table = TableHandler(cls, module_name) if TableHandler.table_exist(cls._table) else None
+        # Migration from in/out times stored as dates
+        migrated = []
+        if table:
+            for name in ('in_time', 'out_time'):
+                if table.column_exist(name) and table._columns[name]['typname'].lower() == 'date':
+                    table.column_rename(name, name + '_date')
+                    migrated.append(name)
+        super(Attendance, cls).__register__(module_name)
+        table = TableHandler(cls, module_name)
+        for name in migrated:
+            # The punches keep their day at midnight, which punctuality skips
+            column, old = getattr(sql_table, name), Column(sql_table, name + '_date')
+            cursor.execute(*sql_table.select(old, where=old != Null, group_by=[old]))
+            for day, in cursor.fetchall():
+                cursor.execute(*sql_table.update([column], [datetime.datetime.combine(day, datetime.time())],
+                        where=old == day))
+            table.drop_column(name + '_date')
+
     @classmethod
     def __setup__(cls):
         super(Attendance, cls).__setup__()
@@ -65,7 +232,7 @@ class Attendance(ModelSQL, ModelView):
 
     def check_times(self):
         """Check if the In time and Out time are on same day"""
-        if self.in_time and self.out_time and not (self.in_time == self.out_time):
+        if self.in_time and self.out_time and not (self.in_time.date() == self.out_time.date()):
             return False
         return True
 
@@ -79,49 +246,484 @@ class Attendance(ModelSQL, ModelView):
         if self.in_time:
             return {'date': self.in_time.date()}
 
-    def get_period(self):
+    @classmethod
+    def delete(cls, attendances):
+        # Deleted rows leave no write date, so flag their summaries instead
+        Pool().get('employee.attendance.summary').invalidate([a.id for a in attendances])
+        super(Attendance, cls).delete(attendances)
+
+    @classmethod
+    def get_period(cls, attendances, name):
         period1 = Pool().get('payroll.period')
-        periods = period1.search(
-            [('state', '=', 'open'), ('start_date', '<=', self.date), ('end_date', '>=', self.date), ])
-        if not periods or len(periods) > 1:
-            self.raise_user_error('invalid_period')
-        return periods[0].id
-
-    def get_is_holiday(self):
-        if not self.period:
-            return False
-        holidays = [holiday.date for holiday in self.period.holidays]
-        if self.on_leave:
-            date = self.date
-        else:
-            date = self.in_time.date()
-        if date in holidays:
-            return True
-        return False
+        periods = {}
+        for attendance in attendances:
+            employee = attendance.employee
+            periods[attendance.id] = period1.find(employee.company.id,
+                employee.department.id if employee.department else None, attendance.date)
+        return periods
 
+    @classmethod
+    def _period_join(cls, attendance):
+        """
+            Join the attendance table to the open payroll period of the
+            employee's department and return it with the period table
+        """
+        pool = Pool()
+        Employee = pool.get('company.employee')
+        PayrollYear = pool.get('payroll.year')
+        PayrollPeriod = pool.get('payroll.period')
+        employee = Employee.__table__()
+        year = PayrollYear.__table__()
+        period = PayrollPeriod.__table__()
+        join = attendance.join(employee, condition=attendance.employee == employee.id
+            ).join(year, condition=year.company == employee.company
+            ).join(period, condition=(period.payroll_year == year.id)
+                & (period.state == 'open')
+                & (period.start_date <= attendance.date)
+                & (period.end_date >= attendance.date)
+                & (period.department == employee.department))
+        return join, period
 
-class AttendanceSummary(ModelSQL, ModelView):
-    """Attendance Summary"""
+    @classmethod
+    def _holiday_query(cls, ids=None):
+        """Return the query of attendance ids falling on a holiday of their period"""
+        Holiday = Pool().get('payroll.holiday')
+        attendance = cls.__table__()
+        holiday = Holiday.__table__()
+        join, period = cls._period_join(attendance)
+        where = Literal(True)
+        if ids is not None:
+            where = reduce_ids(attendance.id, ids)
+        return join.join(holiday, condition=(holiday.period == period.id) & (holiday.date == attendance.date)
+            ).select(attendance.id, where=where)
 
     @classmethod
-    def write(cls, records, values, *args):
-        pass
+    def search_period(cls, name, clause):
+        Period = Pool().get('payroll.period')
+        attendance = cls.__table__()
+        join, period = cls._period_join(attendance)
+        name, operator, value = clause[:3]
+        if '.' in name:
+            nested = name.split('.', 1)[1]
+            operator, value = 'in', [p.id for p in Period.search([(nested, operator, value)])]
+        elif operator not in ('=', '!=', 'in', 'not in') or isinstance(value, basestring):
+            operator, value = 'in', [p.id for p in Period.search([('rec_name', operator, value)])]
+        if value is None:
+            # Attendance without a period are the ones missing from the join
+            return [('id', 'not in' if operator == '=' else 'in', join.select(attendance.id))]
+        Operator = fields.SQL_OPERATORS[operator]
+        return [('id', 'in', join.select(attendance.id, where=Operator(period.id, value)))]
+
+    @staticmethod
+    def order_period(tables):
+        # Periods do not overlap so they sort like the attendance date
+        table, _ = tables[None]
+        return [table.date]
+
+    @classmethod
+    def get_is_holiday(cls, attendances, name):
+        cursor = Transaction().connection.cursor()
+        holiday_ids = set()
+        for sub_ids in grouped_slice([a.id for a in attendances]):
+            cursor.execute(*cls._holiday_query(sub_ids))
+            holiday_ids.update(x for x, in cursor.fetchall())
+        return dict((a.id, a.id in holiday_ids) for a in attendances)
+
+    @classmethod
+    def search_is_holiday(cls, name, clause):
+        _, operator, value = clause[:3]
+        if (operator == '=') == bool(value):
+            return [('id', 'in', cls._holiday_query())]
+        return [('id', 'not in', cls._holiday_query())]
+
+    @classmethod
+    def order_is_holiday(cls, tables):
+        table, _ = tables[None]
+        return [Case((table.id.in_(cls._holiday_query()), 1), else_=0)]
+
+
+class AttendanceImport(ModelSQL, ModelView):
+    """Attendance Import"""
+    __name__ = 'employee.attendance.import'
+    name = fields.Char('File Name', required=True, states={'readonly': Eval('state') != 'draft'}, depends=['state'])
+    data = fields.Binary('Punch File', filename='name', file_id='data_id', required=True,
+                         states={'readonly': Eval('state') != 'draft'}, depends=['state'])
+    data_id = fields.Char('Punch File ID', readonly=True)
+    line = fields.Integer('Last Imported Line', readonly=True)
+    imported = fields.Integer('Imported', readonly=True)
+    rejected = fields.Integer('Rejected', readonly=True)
+    rejects = fields.Text('Rejected Lines', readonly=True)
+    state = fields.Selection([('draft', 'Draft'), ('running', 'Running'), ('failed', 'Failed'), ('done', 'Done')],
+                             'State', readonly=True, required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AttendanceImport, cls).__setup__()
+        cls._buttons.update({'start': {'invisible': ~Eval('state').in_(['draft', 'failed'])}})
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        # Migration from imports of a server file path
+        if TableHandler.table_exist(cls._table):
+            table = TableHandler(cls, module_name)
+            if table.column_exist('path'):
+                table.column_rename('path', 'name')
+        super(AttendanceImport, cls).__register__(module_name)
+
+    @staticmethod
+    def default_line():
+        return 0
+
+    @staticmethod
+    def default_imported():
+        return 0
+
+    @staticmethod
+    def default_rejected():
+        return 0
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @classmethod
+    @ModelView.button
+    def start(cls, imports):
+        # Queue the imports for the cron, a failed one resumes where it stopped
+        cls.write(imports, {'state': 'running'})
+
+    @classmethod
+    def process(cls, chunk_size=1000):
+        """
+            Run the queued imports. Called by the cron, outside of any client
+            request, as each chunk is committed so that a failed import is
+            resumed after its last committed chunk
+        """
+        for import_ in cls.search([('state', '=', 'running')]):
+            cls.run(import_, chunk_size)
+
+    @classmethod
+    def run(cls, import_, chunk_size=1000):
+        """
+            Stream the punch file into attendance, committing every chunk with
+            the progress of the import. The rejected lines are written at the end
+        """
+        pool = Pool()
+        Attendance = pool.get('employee.attendance')
+        Employee = pool.get('company.employee')
+        employee = Employee.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        line, imported, rejected = import_.line, import_.imported, import_.rejected
+        # The rejects are written once, only the committed ones if it fails
+        rejects, errors, committed = import_.rejects or '', [], 0
 
+        cursor.execute(*employee.select(employee.employee_id, employee.id,
+                where=employee.employee_id != Null))
+        index = dict(cursor.fetchall())
+
+        file_ = open_punches(import_)
+        items = read_punches(file_, line)
+        items = parse_punches(items, Attendance._fields)
+        items = map_badges(items, index)
+        items = deduplicate_punches(items, chunk_size)
+        items = validate_punches(items, Attendance)
+        try:
+            for chunk in chunked(items, chunk_size):
+                to_create = [v for _, v, e in chunk if not e]
+                errors.extend((n, e) for n, _, e in chunk if e)
+                if to_create:
+                    Attendance.create(to_create)
+                line = chunk[-1][0]
+                imported += len(to_create)
+                rejected += len(chunk) - len(to_create)
+                cls.write([import_], {'line': line, 'imported': imported, 'rejected': rejected})
+                transaction.commit()
+                committed = len(errors)
+        except Exception:
+            transaction.rollback()
+            cls.write([import_], {'state': 'failed',
+                    'rejects': rejects + format_rejects(errors[:committed])})
+            transaction.commit()
+            raise
+        finally:
+            file_.close()
+        cls.write([import_], {'state': 'done', 'rejects': rejects + format_rejects(errors)})
+        transaction.commit()
+
+
+class AttendanceSummary(Instrumented, ModelSQL, ModelView):
+    """Attendance Summary"""
     __name__ = 'employee.attendance.summary'
-    employee = fields.Many2One('company.employee', 'Employee', required=True, select=True)
-    period = fields.Function(fields.Many2One('payroll.period', 'Period'), 'get_period')
-    full_days = fields.Integer('Full Days')
-    half_days = fields.Integer('Half Days')
-    leaves = fields.Numeric('Leaves Taken')
+    employee = fields.Many2One('company.employee', 'Employee', required=True, select=True, readonly=True)
+    period = fields.Many2One('payroll.period', 'Period', required=True, select=True, readonly=True)
+    full_days = fields.Integer('Full Days', readonly=True)
+    half_days = fields.Integer('Half Days', readonly=True)
+    leaves = fields.Numeric('Leaves Taken', readonly=True)
+    refresh_date = fields.DateTime('Refresh Date', readonly=True, select=True)
 
+    @classmethod
+    def __setup__(cls):
+        super(AttendanceSummary, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints = [
+            ('employee_period_uniq', Unique(t, t.employee, t.period),
+             'There can be only one attendance summary per employee and period.')
+        ]
+        cls.__rpc__.update({'refresh': RPC(readonly=False)})
 
-class LeaveApplication(Workflow, ModelSQL, ModelView):
-    """Leave Application"""
+    @classmethod
+    def compute(cls, employee_ids):
+        """
+            Aggregate the attendance of the employees per payroll period
+            into {(employee id, period id): (full days, half days, leaves)}
+        """
+        pool = Pool()
+        Attendance = pool.get('employee.attendance')
+        LeaveApplication = pool.get('employee.leave.application')
+        attendance = Attendance.__table__()
+        application = LeaveApplication.__table__()
+        cursor = Transaction().connection.cursor()
+        join, period = Attendance._period_join(attendance)
+        join = join.join(application, 'LEFT', condition=attendance.leave_application == application.id)
+        on_leave = Coalesce(attendance.on_leave, False) == True
+        cursor.execute(*join.select(attendance.employee, period.id,
+                Sum(Case((~on_leave, 1), else_=0)),
+                Sum(Case((on_leave & (application.type != 'full_day'), 1), else_=0)),
+                Sum(Case((on_leave & (application.type == 'full_day'), 1), else_=0)),
+                where=reduce_ids(attendance.employee, employee_ids),
+                group_by=[attendance.employee, period.id]))
+        return dict(((employee_id, period_id), (full_days, half_days, full_leaves + Decimal('0.5') * half_days))
+            for employee_id, period_id, full_days, half_days, full_leaves in cursor.fetchall())
 
     @classmethod
-    def write(cls, records, values, *args):
-        pass
+    def invalidate(cls, attendance_ids):
+        """Flag for the next refresh the summaries of the attendance"""
+        Attendance = Pool().get('employee.attendance')
+        attendance = Attendance.__table__()
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        for sub_ids in grouped_slice(attendance_ids):
+            join, period = Attendance._period_join(attendance)
+            cursor.execute(*join.select(attendance.employee, period.id,
+                    where=reduce_ids(attendance.id, sub_ids),
+                    group_by=[attendance.employee, period.id]))
+            for employee_id, period_id in cursor.fetchall():
+                cursor.execute(*table.update([table.refresh_date], [Null],
+                        where=(table.employee == employee_id) & (table.period == period_id)))
+
+    @classmethod
+    def touched(cls, since):
+        """Return the (employee id, period id) of attendance changed since the date"""
+        Attendance = Pool().get('employee.attendance')
+        attendance = Attendance.__table__()
+        cursor = Transaction().connection.cursor()
+        join, period = Attendance._period_join(attendance)
+        cursor.execute(*join.select(attendance.employee, period.id,
+                where=Coalesce(attendance.write_date, attendance.create_date) >= since,
+                group_by=[attendance.employee, period.id]))
+        return set(cursor.fetchall())
+
+    @classmethod
+    def refresh(cls, full=False, chunk_size=1000):
+        """
+            Refresh the summaries of the attendance created, written or
+            deleted since the last refresh, or all of them when full is set
+        """
+        Employee = Pool().get('company.employee')
+        employee = Employee.__table__()
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # The refresh dates come from the database clock like the write
+        # dates, the overlap catches the transactions committed meanwhile
+        last = cls.search([('refresh_date', '!=', None)], order=[('refresh_date', 'DESC')], limit=1)
+        if full or not last:
+            touched = None
+            cursor.execute(*employee.select(employee.id, order_by=[employee.id]))
+            employee_ids = [x for x, in cursor.fetchall()]
+        else:
+            touched = cls.touched(last[0].refresh_date - REFRESH_OVERLAP)
+            cursor.execute(*table.select(table.employee, table.period, where=table.refresh_date == Null))
+            touched.update(cursor.fetchall())
+            employee_ids = sorted(set(k[0] for k in touched))
 
+        for sub_ids in grouped_slice(employee_ids, chunk_size):
+            sub_ids = list(sub_ids)
+            values = cls.compute(sub_ids)
+            if touched is not None:
+                ids = set(sub_ids)
+                keys = set(k for k in touched if k[0] in ids)
+            else:
+                keys = set(values.keys())
+            summaries = dict(((s.employee.id, s.period.id), s) for s in cls.search([('employee', 'in', sub_ids)]))
+            to_delete, to_write, to_create = [], [], []
+            if touched is None:
+                to_delete = [s for k, s in summaries.items() if k not in values]
+            for key in keys:
+                if key not in values:
+                    if key in summaries:
+                        to_delete.append(summaries[key])
+                    continue
+                full_days, half_days, leaves = values[key]
+                row = {'full_days': full_days, 'half_days': half_days, 'leaves': leaves}
+                if key in summaries:
+                    to_write.extend(([summaries[key]], row))
+                else:
+                    row.update({'employee': key[0], 'period': key[1]})
+                    to_create.append(row)
+            if to_delete:
+                cls.delete(to_delete)
+            refreshed = [r.id for records in to_write[::2] for r in records]
+            if to_write:
+                cls.write(*to_write)
+            if to_create:
+                refreshed.extend(s.id for s in cls.create(to_create))
+            for ids in grouped_slice(refreshed):
+                cursor.execute(*table.update([table.refresh_date], [CurrentTimestamp()],
+                        where=reduce_ids(table.id, ids)))
+
+
+def count_violations(rows, policies):
+    """
+        Count the late comings and early departures of the punches
+                  param rows: list of (employee id, department id, in time, out time)
+                  param policies: dict of department id to its resolved thresholds
+        Return {employee id: [department id, late comings, early departures]}
+        Times at midnight are days without time of punch and are not counted
+    """
+    counts = {}
+    midnight = datetime.time()
+    for employee_id, department_id, in_time, out_time in rows:
+        policy = policies.get(department_id, {})
+        count = counts.setdefault(employee_id, [department_id, 0, 0])
+        if in_time and in_time.time() == midnight:
+            in_time = None
+        if out_time and out_time.time() == midnight:
+            out_time = None
+        if in_time and policy.get('late_coming_time') and in_time.time() > policy['late_coming_time']:
+            count[1] += 1
+        if out_time and policy.get('early_departure_time') and out_time.time() < policy['early_departure_time']:
+            count[2] += 1
+    return counts
+
+
+class Punctuality(Instrumented, ModelSQL, ModelView):
+    """Punctuality"""
+    __name__ = 'employee.punctuality'
+    employee = fields.Many2One('company.employee', 'Employee', required=True, readonly=True, ondelete='CASCADE')
+    department = fields.Many2One('company.department', 'Department', required=True, readonly=True,
+                                 ondelete='CASCADE')
+    month = fields.Date('Month', required=True, readonly=True, select=True)
+    late_comings = fields.Integer('Late Comings', readonly=True)
+    allowed_late_comings = fields.Integer('Allowed Late Comings', readonly=True)
+    excess_late_comings = fields.Integer('Excess Late Comings', readonly=True)
+    early_departures = fields.Integer('Early Departures', readonly=True)
+    allowed_early_departures = fields.Integer('Allowed Early Departures', readonly=True)
+    excess_early_departures = fields.Integer('Excess Early Departures', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Punctuality, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints = [
+            ('employee_month_uniq', Unique(t, t.employee, t.month),
+             'There can be only one punctuality evaluation per employee and month.')
+        ]
+        cls._order.insert(0, ('month', 'DESC'))
+        cls.__rpc__.update({'evaluate': RPC(readonly=False)})
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        super(Punctuality, cls).__register__(module_name)
+        table = TableHandler(cls, module_name)
+        table.index_action(['department', 'month'], 'add')
+
+    @classmethod
+    def get_policies(cls, company_id):
+        """
+            Return the thresholds of each department of the company, the ones
+            left empty being inherited from the nearest parent defining them
+        """
+        Department = Pool().get('company.department')
+        department = Department.__table__()
+        cursor = Transaction().connection.cursor()
+        names = ['late_coming_time', 'allowed_late_comings', 'early_departure_time', 'allowed_early_departures']
+        cursor.execute(*department.select(department.id, department.path,
+                *[getattr(department, n) for n in names], where=department.company == company_id))
+        own, paths = {}, {}
+        for row in cursor.fetchall():
+            paths[row[0]] = row[1] or '/%s/' % row[0]
+            own[row[0]] = dict(zip(names, row[2:]))
+        policies = {}
+        for department_id, path in paths.iteritems():
+            policy = {}
+            # The path lists the ancestors from the root, so walk it backward
+            for ancestor_id in reversed([int(i) for i in path.strip('/').split('/')]):
+                for name, value in own.get(ancestor_id, {}).iteritems():
+                    if policy.get(name) is None:
+                        policy[name] = value
+            policies[department_id] = policy
+        return policies
+
+    @classmethod
+    def evaluate_departments(cls, company_id, department_ids, month):
+        "Evaluate the month of attendance of the employees of the departments"
+        pool = Pool()
+        Attendance = pool.get('employee.attendance')
+        Employee = pool.get('company.employee')
+        attendance = Attendance.__table__()
+        employee = Employee.__table__()
+        cursor = Transaction().connection.cursor()
+        month = month.replace(day=1)
+        end = month + relativedelta(months=1, days=-1)
+        policies = cls.get_policies(company_id)
+
+        cursor.execute(*employee.select(employee.id, where=reduce_ids(employee.department, department_ids)))
+        employee_ids = [x for x, in cursor.fetchall()]
+        # An employee has one evaluation per month, whatever its department was
+        cls.delete(cls.search([
+                    ['OR', ('department', 'in', department_ids), ('employee', 'in', employee_ids)],
+                    ('month', '=', month),
+                    ]))
+        cursor.execute(*attendance.join(employee, condition=attendance.employee == employee.id
+                ).select(attendance.employee, employee.department, attendance.in_time, attendance.out_time,
+                where=reduce_ids(employee.department, department_ids)
+                & (attendance.date >= month) & (attendance.date <= end)
+                & (Coalesce(attendance.on_leave, False) == False)))
+        counts = count_violations(cursor.fetchall(), policies)
+        to_create = []
+        for employee_id, (department_id, late, early) in counts.iteritems():
+            policy = policies.get(department_id, {})
+            allowed_late = policy.get('allowed_late_comings') or 0
+            allowed_early = policy.get('allowed_early_departures') or 0
+            to_create.append({
+                    'employee': employee_id,
+                    'department': department_id,
+                    'month': month,
+                    'late_comings': late,
+                    'allowed_late_comings': allowed_late,
+                    'excess_late_comings': max(late - allowed_late, 0),
+                    'early_departures': early,
+                    'allowed_early_departures': allowed_early,
+                    'excess_early_departures': max(early - allowed_early, 0),
+                    })
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def evaluate(cls, company_id, month):
+        "Evaluate the punctuality of all the employees of the company for the month"
+        Department = Pool().get('company.department')
+        department_ids = [d.id for d in Department.search([('company', '=', company_id)])]
+        if department_ids:
+            cls.evaluate_departments(company_id, department_ids, month)
+
+
+class LeaveApplication(Instrumented, Workflow, ModelSQL, ModelView):
+    """Leave Application"""
     __name__ = 'employee.leave.application'
     from_date = fields.Date('From Date', required=True, select=True, states={'readonly': Eval('state') != 'Draft'},
                             depends=['state'])
@@ -134,10 +736,7 @@ class LeaveApplication(Workflow, ModelSQL, ModelView):
     type = fields.Selection([('full_day', 'Full Day'), ('first_half', 'First Half'), ('second_half', 'Second Half')],
                             'Type',
                             required=True, states={'readonly': Eval('state') != 'Draft'}, depends=['state'])
-    leave_type = fields.Selection(
-        [('casual', 'Casual Leave'), ('Sick', 'Sick Leave'), ('earned', 'earned Leave'), ('study', 'Study Leave'),
-         ('paternity', 'Paternity Leave'),
-         ('annual', 'Annual Leave')], 'Leave Type',
+    leave_type = fields.Selection(LEAVE_TYPE, 'Leave Type',
         required=True, states={'readonly': Eval('state') != 'Draft'}, depends=['state'])
     state = fields.Selection(
         [('Draft', 'Draft'), ('In Review', 'In Review'), ('Approved', 'Approved'), ('Denied', 'Denied')], 'State',
@@ -155,12 +754,14 @@ class LeaveApplication(Workflow, ModelSQL, ModelView):
     def __setup__(cls):
         super(LeaveApplication, cls).__setup__()
         cls._order.insert(0, ('from_date', 'DESC'))
-        cls._transitions |= {('Draft', 'In Review'), ('In Review', 'Approved'), ('In Review', 'Denied')}
+        cls._transitions |= {('Draft', 'In Review'), ('In Review', 'Approved'), ('In Review', 'Denied'),
+                             ('Approved', 'Draft')}
         cls._buttons.update({'review': {'invisible': Eval('state') != 'Draft', }, 'approve': {'invisible': Eval('state')
-                            != 'In Review'}, 'deny': {'invisible': Eval('state') != 'In Review', }})
-        cls._error_messages.update({'wrong_type': 'OOPS! Half day leaves are not implemented yet'})
+                            != 'In Review'}, 'deny': {'invisible': Eval('state') != 'In Review', },
+                             'revert': {'invisible': Eval('state') != 'Approved', }})
+        cls._error_messages.update({'wrong_type': 'OOPS! Half day leaves are not implemented yet',
+                                    'leave_overlap': 'Employee "%s" is already on leave on %s.'})
 
-    @property
     def check_type(self):
         """Type cannot be half day if from and to dates are not same"""
         if self.type != 'full_day':
@@ -179,14 +780,257 @@ class LeaveApplication(Workflow, ModelSQL, ModelView):
     @ModelView.button
     @Workflow.transition('Approved')
     def approve(cls, apps):
-        attendance1 = Pool().get('employee.attendance')
+        pool = Pool()
+        attendance1 = pool.get('employee.attendance')
+        LeaveLedger = pool.get('employee.leave.ledger')
+        to_create, days = [], []
         for app in apps:
             for single_date in daterange(app.from_date, app.to_date):
-                attendance1.create(
+                to_create.append(
                     {'employee': app.employee.id, 'date': single_date, 'on_leave': True, 'leave_application': app.id})
+                days.append((app.employee.id, single_date, app.leave_type))
+        cls.check_leave_days(days)
+        attendance1.create(to_create)
+        LeaveLedger.update_taken(days)
+
+    @classmethod
+    def check_leave_days(cls, days):
+        """
+            Check in one query per chunk of employees that none of the days
+            is already a leave day of the employee
+                  param days: list of (employee id, date, leave type)
+        """
+        pool = Pool()
+        Attendance = pool.get('employee.attendance')
+        Employee = pool.get('company.employee')
+        attendance = Attendance.__table__()
+        cursor = Transaction().connection.cursor()
+        if not days:
+            return
+        requested = set()
+        for employee_id, date, _ in days:
+            if (employee_id, date) in requested:
+                cls.raise_user_error('leave_overlap', (Employee(employee_id).rec_name, date))
+            requested.add((employee_id, date))
+        from_date = min(d[1] for d in days)
+        to_date = max(d[1] for d in days)
+        for sub_ids in grouped_slice(list(set(d[0] for d in days))):
+            cursor.execute(*attendance.select(attendance.employee, attendance.date,
+                    where=reduce_ids(attendance.employee, sub_ids)
+                    & (attendance.on_leave == True)
+                    & (attendance.date >= from_date)
+                    & (attendance.date <= to_date)))
+            for employee_id, date in cursor.fetchall():
+                if (employee_id, date) in requested:
+                    cls.raise_user_error('leave_overlap', (Employee(employee_id).rec_name, date))
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('Draft')
+    def revert(cls, apps):
+        pool = Pool()
+        Attendance = pool.get('employee.attendance')
+        LeaveLedger = pool.get('employee.leave.ledger')
+        attendances = Attendance.search([
+                ('leave_application', 'in', [app.id for app in apps]),
+                ('on_leave', '=', True),
+                ])
+        LeaveLedger.update_taken([(a.employee.id, a.date, a.leave_application.leave_type) for a in attendances],
+                                 sign=-1)
+        Attendance.delete(attendances)
 
     @classmethod
     @ModelView.button
     @Workflow.transition('Denied')
     def deny(cls, apps):
         pass
+
+
+class LeaveLedger(Instrumented, ModelSQL, ModelView):
+    """Leave Ledger"""
+    __name__ = 'employee.leave.ledger'
+    employee = fields.Many2One('company.employee', 'Employee', required=True, select=True, readonly=True)
+    # The dates of the payroll year rather than the year itself, so the
+    # entries still match after the employee moves to another department
+    start_date = fields.Date('Start Date', required=True, readonly=True)
+    end_date = fields.Date('End Date', required=True, readonly=True)
+    leave_type = fields.Selection(LEAVE_TYPE, 'Leave Type', required=True, readonly=True)
+    taken = fields.Integer('Leaves Taken', required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(LeaveLedger, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints = [
+            ('employee_dates_type_uniq', Unique(t, t.employee, t.start_date, t.end_date, t.leave_type),
+             'There can be only one ledger entry per employee, payroll year and leave type.')
+        ]
+        cls.__rpc__.update({'rebuild': RPC(readonly=False)})
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+        created = not TableHandler.table_exist(cls._table)
+        migrate = not created and not TableHandler(cls, module_name).column_exist('start_date')
+        if migrate:
+            # Migration from the entries keyed by payroll year, rebuilt below
+            cursor.execute(*sql_table.delete())
+        super(LeaveLedger, cls).__register__(module_name)
+        table = TableHandler(cls, module_name)
+        if migrate:
+            table.drop_constraint('employee_year_type_uniq')
+            table.drop_column('payroll_year')
+        if created or migrate:
+            # Count the leaves approved before the ledger existed
+            cls.rebuild()
+
+    @staticmethod
+    def default_taken():
+        return 0
+
+    @classmethod
+    def get_payrollyears(cls, days):
+        """
+            Return the (start date, end date) of the open payroll year of the
+            employee for each day, or None
+                  param days: list of (employee id, date)
+        """
+        pool = Pool()
+        Employee = pool.get('company.employee')
+        PayrollYear = pool.get('payroll.year')
+        employees = dict((e.id, e) for e in Employee.browse(list(set(d[0] for d in days))))
+        year_ids = {}
+        for employee_id, date in set(days):
+            employee = employees[employee_id]
+            year_ids[(employee_id, date)] = PayrollYear.find(employee.company.id,
+                employee.department.id if employee.department else None, date)
+        dates = cls.get_year_dates(year_ids.values())
+        return dict((key, dates.get(year_id)) for key, year_id in year_ids.iteritems())
+
+    @staticmethod
+    def get_year_dates(year_ids):
+        "Return {payroll year id: (start date, end date)}"
+        PayrollYear = Pool().get('payroll.year')
+        year = PayrollYear.__table__()
+        cursor = Transaction().connection.cursor()
+        dates = {}
+        for sub_ids in grouped_slice(list(set(i for i in year_ids if i))):
+            cursor.execute(*year.select(year.id, year.start_date, year.end_date,
+                    where=reduce_ids(year.id, sub_ids)))
+            dates.update((i, (start, end)) for i, start, end in cursor.fetchall())
+        return dates
+
+    @classmethod
+    def update_taken(cls, days, sign=1):
+        """
+            Add (or remove with sign=-1) the leave days to the ledger
+                  param days: list of (employee id, date, leave type)
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        years = cls.get_payrollyears([d[:2] for d in days])
+        deltas = defaultdict(int)
+        for employee_id, date, leave_type in days:
+            year = years[(employee_id, date)]
+            if year:
+                deltas[(employee_id, year, leave_type)] += sign
+        if not deltas:
+            return
+
+        existing = {}
+        for sub_ids in grouped_slice(list(set(k[0] for k in deltas))):
+            cursor.execute(*table.select(table.id, table.employee, table.start_date, table.end_date,
+                    table.leave_type, where=reduce_ids(table.employee, sub_ids)))
+            for ledger_id, employee_id, start_date, end_date, leave_type in cursor.fetchall():
+                existing[(employee_id, (start_date, end_date), leave_type)] = ledger_id
+
+        to_create = []
+        for key, delta in deltas.items():
+            if key in existing:
+                # Increment in SQL so concurrent approvals do not lose updates
+                cursor.execute(*table.update([table.taken], [table.taken + delta],
+                        where=table.id == existing[key]))
+            else:
+                employee_id, (start_date, end_date), leave_type = key
+                to_create.append({'employee': employee_id, 'start_date': start_date, 'end_date': end_date,
+                                  'leave_type': leave_type, 'taken': delta})
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def get_taken(cls, employee_years):
+        """
+            Return the leaves taken per (employee id, leave type)
+                  param employee_years: dict of employee id to payroll year id
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        dates = cls.get_year_dates(employee_years.values())
+        taken = defaultdict(int)
+        for sub_ids in grouped_slice(list(employee_years.keys())):
+            cursor.execute(*table.select(table.employee, table.start_date, table.end_date, table.leave_type,
+                    table.taken, where=reduce_ids(table.employee, sub_ids)))
+            for employee_id, start_date, end_date, leave_type, count in cursor.fetchall():
+                if dates.get(employee_years[employee_id]) == (start_date, end_date):
+                    taken[(employee_id, leave_type)] = count
+        return taken
+
+    @classmethod
+    def compute_taken(cls, employee_ids):
+        """Recompute from attendance the ledger entries of the employees"""
+        pool = Pool()
+        Attendance = pool.get('employee.attendance')
+        LeaveApplication = pool.get('employee.leave.application')
+        attendance = Attendance.__table__()
+        application = LeaveApplication.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*attendance.join(application,
+                condition=attendance.leave_application == application.id
+                ).select(attendance.employee, attendance.date, application.leave_type, Count(attendance.id),
+                where=reduce_ids(attendance.employee, employee_ids)
+                & (attendance.on_leave == True),
+                group_by=[attendance.employee, attendance.date, application.leave_type]))
+        rows = cursor.fetchall()
+        years = cls.get_payrollyears([r[:2] for r in rows])
+        taken = defaultdict(int)
+        for employee_id, date, leave_type, count in rows:
+            year = years[(employee_id, date)]
+            if year:
+                taken[(employee_id, year, leave_type)] += count
+        return taken
+
+    @classmethod
+    def rebuild(cls, chunk_size=1000):
+        """
+            Recompute the whole ledger from attendance, one chunk of employees
+            at a time, and return the number of entries corrected
+        """
+        Employee = Pool().get('company.employee')
+        employee = Employee.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*employee.select(employee.id, order_by=[employee.id]))
+        employee_ids = [x for x, in cursor.fetchall()]
+
+        corrected = 0
+        for sub_ids in grouped_slice(employee_ids, chunk_size):
+            sub_ids = list(sub_ids)
+            expected = cls.compute_taken(sub_ids)
+            to_delete, to_write = [], []
+            for entry in cls.search([('employee', 'in', sub_ids)]):
+                key = (entry.employee.id, (entry.start_date, entry.end_date), entry.leave_type)
+                count = expected.pop(key, 0)
+                if not count:
+                    to_delete.append(entry)
+                elif count != entry.taken:
+                    to_write.extend(([entry], {'taken': count}))
+            if to_delete:
+                cls.delete(to_delete)
+            if to_write:
+                cls.write(*to_write)
+            if expected:
+                cls.create([{'employee': e, 'start_date': y[0], 'end_date': y[1], 'leave_type': t, 'taken': c}
+                        for (e, y, t), c in expected.items()])
+            corrected += len(to_delete) + len(to_write) // 2 + len(expected)
+        return corrected
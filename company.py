@@ -7,15 +7,32 @@
 # license: BSD, see LICENSE for more details.
 
 
+import json
+import logging
+from collections import defaultdict
 from datetime import datetime
+from io import BytesIO
 from dateutil.relativedelta import relativedelta
+from sql import Column, Literal, Null, Table
+from sql.aggregate import Count, Min
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp, Extract, Substring
+from sql.operators import Concat
+from trytond import backend
 from trytond.backend.database import CursorInterface
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.filestore import filestore
 from trytond.model import ModelView, ModelSQL, Workflow, fields, Unique
 from trytond.modules.company import company
 from trytond.pool import Pool, PoolMeta
+from trytond.protocols.jsonrpc import JSONDecoder, JSONEncoder
 from trytond.pyson import Eval, Bool, If
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond.wizard import Wizard, StateView, Button, StateTransition
+from .instrument import Instrumented
 import pytz
 
 try:
@@ -25,19 +42,92 @@ except ImportError:
     TIMEZONES = []
 TIMEZONES += [(None, '')]
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+THUMBNAIL_SIZE = (64, 64)
+
+logger = logging.getLogger(__name__)
+
 CursorInterface.cache_keys.update({'company', 'employee'})
 
 
 __all__ = ['Department', 'Employee', 'Responsibility', 'Language', 'Academic', 'Skill', 'Team',
            'TransferProposal', 'TransferRemark', 'Party', 'PaymentDetail', 'EmployeeHistory',
-           'Property', 'Date', 'EmployeeConfig', 'EmployeeConfigStart', 'Rule']
+           'EmployeeRevision', 'EmployeeClosure', 'ReorganizeStart', 'ReorganizeLine', 'Reorganize', 'Property',
+           'Date', 'EmployeeConfig', 'EmployeeConfigStart', 'Rule']
 
 STATES = {'readonly': Eval('active', True), }
 
+# 'full' copies the whole employee row into its history table on each write,
+# 'delta' only records the changed fields as company.employee.revision
+HISTORY_MODE = config.get('hr', 'history', default='full')
+
+# Employee fields combined into the search key
+SEARCH_KEY_FIELDS = ['employee_id', 'first_name', 'middle_name', 'last_name']
+
+# Leave type of employee.leave.application counted by each available_* field
+LEAVE_TYPES = {
+    'available_cl': 'casual',
+    'available_sl': 'Sick',
+    'available_el': 'earned',
+    'available_dl': 'study',
+    'available_pl': 'paternity',
+    'available_al': 'annual',
+}
+
 __metaclass__ = PoolMeta
 
 
-class Department(ModelSQL, ModelView):
+def make_search_key(values, party_name=None):
+    """Return the search key of the employee values and party name"""
+    words = [values[n] for n in SEARCH_KEY_FIELDS if values.get(n)]
+    if party_name:
+        words.append(party_name)
+    return ' '.join(w.strip().lower() for w in words) or None
+
+
+def ensure_extension(name):
+    """
+        Create the PostgreSQL extension if it is missing and return whether
+        it is installed. The database role may lack the right to create it,
+        then a superuser must run CREATE EXTENSION
+    """
+    cursor = Transaction().connection.cursor()
+    cursor.execute('SELECT 1 FROM pg_extension WHERE extname = %s', (name,))
+    if cursor.fetchone():
+        return True
+    cursor.execute('SAVEPOINT hr_extension')
+    try:
+        cursor.execute('CREATE EXTENSION "%s"' % name)
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT hr_extension')
+        logger.warning('Could not create the PostgreSQL extension %s, run "CREATE EXTENSION %s" '
+                       'as a superuser then update the module', name, name, exc_info=True)
+        return False
+    cursor.execute('RELEASE SAVEPOINT hr_extension')
+    return True
+
+
+def make_thumbnail(data):
+    """Return the JPEG thumbnail of the image data, if PIL is installed"""
+    if not data or Image is None:
+        return None
+    try:
+        image = Image.open(BytesIO(data))
+        image.thumbnail(THUMBNAIL_SIZE)
+        thumbnail = BytesIO()
+        image.convert('RGB').save(thumbnail, 'JPEG')
+    except Exception:
+        # A photo PIL can not decode must not block saving the employee
+        logger.warning('Could not make the thumbnail of a photo', exc_info=True)
+        return None
+    return fields.Binary.cast(thumbnail.getvalue())
+
+
+class Department(Instrumented, ModelSQL, ModelView):
     """Company Department"""
     __name__ = 'company.department'
     name = fields.Char('Name', required=True, states=STATES)
@@ -51,6 +141,200 @@ class Department(ModelSQL, ModelView):
     allowed_early_departures = fields.Integer('Allowed Early Departures (per month)', states=STATES)
     late_coming_time = fields.Time('Late Coming Time', states=STATES)
     allowed_late_comings = fields.Integer('Allowed Late Comings (per month)', states=STATES)
+    # Ids from the root down to the department, like /1/4/9/, so a subtree is
+    # the departments whose path starts with the path of its root
+    path = fields.Char('Path', readonly=True, select=True)
+    headcount = fields.Function(fields.Integer('Headcount'), 'get_headcount')
+
+    @classmethod
+    def __setup__(cls):
+        super(Department, cls).__setup__()
+        cls._error_messages.update({'recursive_departments': 'You can not create recursive departments!',
+                                    'overlapping_years': 'The payroll year "%(year)s" of department "%(source)s" '
+                                                         'overlaps a payroll year of department "%(target)s".'})
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        exist = TableHandler.table_exist(cls._table) and TableHandler(cls, module_name).column_exist('path')
+        super(Department, cls).__register__(module_name)
+        if not exist:
+            cursor.execute(*table.select(table.id, table.parent))
+            parents = dict(cursor.fetchall())
+            paths = {}
+
+            def get_path(id_):
+                if id_ not in paths:
+                    parent = parents.get(id_)
+                    paths[id_] = (get_path(parent) if parent else '/') + '%s/' % id_
+                return paths[id_]
+            for id_ in parents:
+                cursor.execute(*table.update([table.path], [get_path(id_)], where=table.id == id_))
+        if backend.name() == 'postgresql':
+            # LIKE 'prefix%' can only use an index with the pattern operators
+            cursor.execute('CREATE INDEX IF NOT EXISTS company_department_path_pattern_index '
+                           'ON company_department (path varchar_pattern_ops)')
+
+    @classmethod
+    def create(cls, vlist):
+        departments = super(Department, cls).create(vlist)
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        parent_ids = set(d.parent.id for d in departments if d.parent) - set(d.id for d in departments)
+        paths = {}
+        for sub_ids in grouped_slice(list(parent_ids)):
+            cursor.execute(*table.select(table.id, table.path, where=reduce_ids(table.id, sub_ids)))
+            paths.update(cursor.fetchall())
+        to_set = list(departments)
+        while to_set:
+            # A department created with its parent in the same call waits for it
+            pending = []
+            for department in to_set:
+                parent_id = department.parent.id if department.parent else None
+                if parent_id and parent_id not in paths:
+                    pending.append(department)
+                    continue
+                paths[department.id] = (paths[parent_id] if parent_id else '/') + '%s/' % department.id
+                cursor.execute(*table.update([table.path], [paths[department.id]], where=table.id == department.id))
+            if len(pending) == len(to_set):
+                cls.raise_user_error('recursive_departments')
+            to_set = pending
+        return departments
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        to_move = []
+        for departments, values in zip(actions, actions):
+            if 'parent' in values:
+                to_move.append((departments, values['parent']))
+        super(Department, cls).write(*args)
+        for departments, parent_id in to_move:
+            cls._move(departments, parent_id)
+
+    @classmethod
+    def delete(cls, departments):
+        super(Department, cls).delete(departments)
+        # Their leave policies are deleted with them
+        Pool().get('employee.leave.policy').clear_cache()
+
+    @classmethod
+    def _move(cls, departments, parent_id):
+        """
+            Rewrite the path of the departments and of their subtrees under the
+            parent, with one UPDATE per moved subtree
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        ids = [d.id for d in departments]
+        parent_path = '/'
+        if parent_id:
+            cursor.execute(*table.select(table.path, where=table.id == parent_id))
+            parent_path, = cursor.fetchone()
+        paths = {}
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(table.id, table.path, where=reduce_ids(table.id, sub_ids)))
+            paths.update(cursor.fetchall())
+        for path in paths.values():
+            if parent_path.startswith(path):
+                cls.raise_user_error('recursive_departments')
+        # Moving an ancestor already moves the departments below it
+        roots = [i for i, p in paths.items() if not any(p != o and p.startswith(o) for o in paths.values())]
+        for id_ in roots:
+            old_path = paths[id_]
+            new_path = parent_path + '%s/' % id_
+            cursor.execute(*table.update([table.path],
+                    [Concat(new_path, Substring(table.path, len(old_path) + 1))],
+                    where=table.path.like(old_path + '%')))
+
+    @classmethod
+    def reparent(cls, departments, parent):
+        "Move the departments with their subtrees under the parent at once"
+        cls.write(list(departments), {'parent': parent.id if parent else None})
+
+    @classmethod
+    def subtree_domain(cls, departments, name='department'):
+        """
+            Return the domain matching the records whose department (name)
+            is in the subtree of one of the departments
+        """
+        return ['OR'] + [('%s.path' % name, 'like', d.path + '%') for d in departments]
+
+    @classmethod
+    def reorganize(cls, mapping, chunk_size=1000):
+        """
+            Move the employees of each source department of the mapping
+            {source id: target id} to its target, a chunk of employees at a
+            time, and hand over the payroll years and periods. A year
+            overlapping one of the target is refused. Each employee is
+            written once, so gets one history revision
+        """
+        pool = Pool()
+        Employee = pool.get('company.employee')
+        PayrollYear = pool.get('payroll.year')
+        PayrollPeriod = pool.get('payroll.period')
+        employee = Employee.__table__()
+        cursor = Transaction().connection.cursor()
+        mapping = dict((s, t) for s, t in mapping.iteritems() if s != t)
+        companies = dict((d.id, d.company.id) for d in cls.browse(list(set(mapping.values()))))
+
+        # Check the handover before moving anyone
+        handovers = defaultdict(list)
+        for year in PayrollYear.search([('department', 'in', list(mapping))]):
+            handovers[mapping[year.department.id]].append(year)
+        kept = [t for t in handovers if t not in mapping]
+        covered = defaultdict(list)
+        for year in PayrollYear.search([('department', 'in', kept)]):
+            covered[year.department.id].append(year)
+        for target_id, years in handovers.iteritems():
+            for year in years:
+                for other in covered[target_id]:
+                    if year.start_date <= other.end_date and year.end_date >= other.start_date:
+                        cls.raise_user_error('overlapping_years', {'year': year.rec_name,
+                                'source': year.department.rec_name, 'target': cls(target_id).rec_name})
+                covered[target_id].append(year)
+
+        moves = []
+        for sub_ids in grouped_slice(list(mapping)):
+            cursor.execute(*employee.select(employee.id, employee.department,
+                    where=reduce_ids(employee.department, sub_ids)))
+            moves.extend(cursor.fetchall())
+        for sub_moves in grouped_slice(moves, chunk_size):
+            targets = defaultdict(list)
+            for employee_id, department_id in sub_moves:
+                targets[mapping[department_id]].append(employee_id)
+            to_write = []
+            for target_id, employee_ids in targets.iteritems():
+                to_write.extend((Employee.browse(employee_ids),
+                        {'department': target_id, 'company': companies[target_id]}))
+            Employee.write(*to_write)
+
+        for target_id, years in handovers.iteritems():
+            PayrollYear.write(years, {'department': target_id, 'company': companies[target_id]})
+            periods = PayrollPeriod.search([('payroll_year', 'in', [y.id for y in years])])
+            if periods:
+                PayrollPeriod.write(periods, {'department': target_id})
+        return len(moves)
+
+    @classmethod
+    def get_headcount(cls, departments, name):
+        # Current employees of each department subtree
+        pool = Pool()
+        Employee = pool.get('company.employee')
+        department = cls.__table__()
+        child = cls.__table__()
+        employee = Employee.__table__()
+        cursor = Transaction().connection.cursor()
+        result = dict((d.id, 0) for d in departments)
+        for sub_ids in grouped_slice(list(result)):
+            cursor.execute(*department.join(child, condition=child.path.like(Concat(department.path, '%'))
+                    ).join(employee, condition=(employee.department == child.id) & (employee.state == 'current')
+                    ).select(department.id, Count(employee.id),
+                    where=reduce_ids(department.id, sub_ids), group_by=department.id))
+            result.update(cursor.fetchall())
+        return result
 
     @staticmethod
     def default_allowed_early_departures():
@@ -65,18 +349,24 @@ class Department(ModelSQL, ModelView):
         return True
 
 
-class Employee(ModelSQL, ModelView):
+class Employee(Instrumented, ModelSQL, ModelView):
     """Employee"""
     __name__ = 'company.employee'
+    _history = HISTORY_MODE != 'delta'
     department = fields.Many2One('company.department', 'Department', domain=[('company', '=', Eval('company'))],
                                  depends=['company'])
-    photo = fields.Binary('Photo')
+    photo = fields.Binary('Photo', file_id='photo_id')
+    photo_id = fields.Char('Photo ID', readonly=True)
+    photo_thumbnail = fields.Binary('Thumbnail', file_id='photo_thumbnail_id', readonly=True)
+    photo_thumbnail_id = fields.Char('Thumbnail ID', readonly=True)
     state = fields.Selection([('current', 'Current'), ('retired', 'Retired'), ('closed', 'Closed'), ],
                              'State', required=True, )
     first_name = fields.Char('First Name')
     middle_name = fields.Char('Middle Name')
     last_name = fields.Char('Last Name')
     employee_id = fields.Char('Employee ID', readonly=True)
+    # Lower case employee id and names, searched by search_rec_name
+    search_key = fields.Char('Search Key', readonly=True)
     manager = fields.Many2One('company.employee', 'Manager', domain=[('id', '!=', Eval('id'))],
                               depends=['id'], )
     permanent_address = fields.Many2One('party.address', 'Permanent Address', domain=[('party', '=', Eval('party'))],
@@ -90,7 +380,7 @@ class Employee(ModelSQL, ModelView):
     sex = fields.Selection([('male', 'Male'), ('female', 'Female')], 'Sex')
     date_of_birth = fields.Date('Date of Birth')
     # : Not implemented for death
-    age = fields.Function(fields.Char('Age', depends=['date_of_birth']), 'get_age')
+    age = fields.Function(fields.Char('Age', depends=['date_of_birth']), 'get_age', searcher='search_age')
     place_of_birth = fields.Char('Place of Birth')
     marital_status = fields.Selection([('single', 'Single'), ('married', 'Married')], 'Marital Status')
     wedding_date = fields.Date('Wedding Date', states={'invisible': Eval('marital_status') == 'single',
@@ -123,12 +413,15 @@ class Employee(ModelSQL, ModelView):
     current_payrollyear = fields.Function(fields.Many2One('payroll.year', 'Current Payroll Year'),
                                           'get_current_payrollyear')
     leave_applications = fields.One2Many('employee.leave.application', 'employee', 'Leave Applications')
-    available_cl = fields.Function(fields.Integer('Available Casual Leaves'), 'get_available_cl')
-    available_sl = fields.Function(fields.Integer('Available Sick Leaves'), 'get_available_sl')
-    available_el = fields.Function(fields.Integer('Available Earned Leaves'), 'get_available_el')
-    available_dl = fields.Function(fields.Integer('Available Study Leaves'), 'get_available_dl')
-    available_pl = fields.Function(fields.Integer('Available Paternity Leaves'), 'get_available_pl')
-    available_al = fields.Function(fields.Integer('Available Annual Leaves'), 'get_available_al')
+    available_cl = fields.Function(fields.Integer('Available Casual Leaves'), 'get_available_leaves')
+    available_sl = fields.Function(fields.Integer('Available Sick Leaves'), 'get_available_leaves')
+    available_el = fields.Function(fields.Integer('Available Earned Leaves'), 'get_available_leaves')
+    available_dl = fields.Function(fields.Integer('Available Study Leaves'), 'get_available_leaves')
+    available_pl = fields.Function(fields.Integer('Available Paternity Leaves'), 'get_available_leaves')
+    available_al = fields.Function(fields.Integer('Available Annual Leaves'), 'get_available_leaves')
+    managers = fields.Function(fields.Many2Many('company.employee', None, None, 'Reporting Chain'),
+                               'get_managers', searcher='search_managers')
+    span_of_control = fields.Function(fields.Integer('Direct Reports'), 'get_span_of_control')
 
     @classmethod
     def __setup__(cls):
@@ -139,6 +432,63 @@ class Employee(ModelSQL, ModelView):
              'The Employee ID must be unique.')
         ]
         cls._order.insert(0, ('employee_id', 'ASC'))
+        cls.__rpc__.update({'autocomplete': RPC()})
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Party = pool.get('party.party')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        party = Party.__table__()
+        super(Employee, cls).__register__(module_name)
+        if TableHandler(cls, module_name).column_exist('photo'):
+            cls._migrate_photos()
+        # Fill the keys missing or computed before they had the party name
+        cursor.execute(*table.join(party, 'LEFT', condition=table.party == party.id).select(
+                table.id, table.search_key, party.name, *[Column(table, n) for n in SEARCH_KEY_FIELDS]))
+        for row in cursor.fetchall():
+            key = make_search_key(dict(zip(SEARCH_KEY_FIELDS, row[3:])), row[2])
+            if key != row[1]:
+                cursor.execute(*table.update([table.search_key], [key], where=table.id == row[0]))
+        if backend.name() == 'postgresql' and ensure_extension('pg_trgm'):
+            # Trigram index to match the key on any part of it
+            cursor.execute('CREATE INDEX IF NOT EXISTS company_employee_search_key_trgm_index '
+                           'ON company_employee USING gin (search_key gin_trgm_ops)')
+        else:
+            TableHandler(cls, module_name).index_action('search_key', 'add')
+        if cls._history:
+            # Index the revisions of an employee by change date
+            history_table = TableHandler(cls, module_name, history=True)
+            history_table.index_action(['id', 'write_date'], 'add')
+
+    @classmethod
+    def _migrate_photos(cls):
+        # Move the photos stored inline to the filestore, also those of the
+        # revisions of the history table
+        TableHandler = backend.get('TableHandler')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        tables = [(cls.__table__(), 'id')]
+        if TableHandler.table_exist(cls._table + '__history'):
+            tables.append((Table(cls._table + '__history'), '__id'))
+        for table, key in tables:
+            id_column = Column(table, key)
+            while True:
+                cursor.execute(*table.select(id_column, table.photo,
+                        where=(table.photo != Null) & (table.photo_id == Null), limit=100))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                for row_id, photo in rows:
+                    photo = fields.Binary.cast(photo)
+                    thumbnail = make_thumbnail(photo)
+                    cursor.execute(*table.update(
+                            [table.photo, table.photo_id, table.photo_thumbnail_id],
+                            [Null, filestore.set(photo, prefix=transaction.database.name),
+                                filestore.set(thumbnail, prefix=transaction.database.name) if thumbnail else Null],
+                            where=id_column == row_id))
 
     @staticmethod
     def default_type():
@@ -158,14 +508,180 @@ class Employee(ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
-        Sequence = Pool().get('ir.sequence')
-        Configuration = Pool().get('company.employee.configuration')
         vlist = [x.copy() for x in vlist]
         for values in vlist:
-            if not values.get('employee_id'):
-                config = Configuration(1)
-                values['employee_id'] = Sequence.get_id(config.company_employee_sequence.id)
-        return super(Employee, cls).create(vlist)
+            if values.get('photo'):
+                values['photo_thumbnail'] = make_thumbnail(values['photo'])
+        missing = [values for values in vlist if not values.get('employee_id')]
+        if missing:
+            Configuration = Pool().get('company.employee.configuration')
+            config = Configuration(1)
+            codes = cls._reserve_employee_ids(config.company_employee_sequence, len(missing))
+            for values, code in zip(missing, codes):
+                values['employee_id'] = code
+        party_names = cls._get_party_names([v['party'] for v in vlist if v.get('party')])
+        for values in vlist:
+            values['search_key'] = make_search_key(values, party_names.get(values.get('party')))
+        employees = super(Employee, cls).create(vlist)
+        Pool().get('company.employee.closure').add(employees)
+        if HISTORY_MODE == 'delta':
+            EmployeeRevision = Pool().get('company.employee.revision')
+            EmployeeRevision.record({}, cls.read([e.id for e in employees], cls._revision_fields()))
+        return employees
+
+    @classmethod
+    def _reserve_employee_ids(cls, sequence, count):
+        """
+            Return count codes of the sequence, reserved as one contiguous
+            block with a single update of the sequence row
+        """
+        Sequence = Pool().get('ir.sequence')
+        if count == 1 or sequence.type != 'incremental':
+            return [Sequence.get_id(sequence.id) for _ in range(count)]
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        if sequence.implementation == 'postgresql':
+            cursor.execute('SELECT nextval(%s) FROM generate_series(1, %s)',
+                (sequence._sql_sequence_name, count))
+            numbers = sorted(n for n, in cursor.fetchall())
+        else:
+            # The update locks the sequence row until commit so concurrent
+            # creators get disjoint blocks
+            table = Sequence.__table__()
+            step = sequence.number_increment * count
+            if transaction.database.has_returning():
+                cursor.execute(*table.update([table.number_next_internal], [table.number_next_internal + step],
+                        where=table.id == sequence.id, returning=[table.number_next_internal]))
+            else:
+                cursor.execute(*table.update([table.number_next_internal], [table.number_next_internal + step],
+                        where=table.id == sequence.id))
+                cursor.execute(*table.select(table.number_next_internal, where=table.id == sequence.id))
+            last, = cursor.fetchone()
+            numbers = range(last - step, last, sequence.number_increment)
+        prefix = Sequence._process(sequence.prefix)
+        suffix = Sequence._process(sequence.suffix)
+        return ['%s%s%s' % (prefix, '%%0%sd' % sequence.padding % number, suffix) for number in numbers]
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        EmployeeClosure = pool.get('company.employee.closure')
+        args = list(args)
+        moved = []
+        for i in range(1, len(args), 2):
+            if 'photo' in args[i]:
+                args[i] = args[i].copy()
+                args[i]['photo_thumbnail'] = make_thumbnail(args[i]['photo'])
+            if 'manager' in args[i]:
+                EmployeeClosure.check_cycle(args[i - 1], args[i]['manager'])
+                moved.extend(args[i - 1])
+        if HISTORY_MODE != 'delta':
+            super(Employee, cls).write(*args)
+        else:
+            EmployeeRevision = pool.get('company.employee.revision')
+            written = set(n for values in args[1::2] for n in values)
+            if 'photo' in written:
+                # The filestore sets the file id of the photo, record it
+                written.add('photo_id')
+            names = set(cls._revision_fields()) & written
+            ids = list(set(r.id for records in args[::2] for r in records))
+            before = cls.read(ids, list(names)) if names else []
+            super(Employee, cls).write(*args)
+            if names:
+                EmployeeRevision.record(dict((r['id'], r) for r in before), cls.read(ids, list(names)))
+        if moved:
+            EmployeeClosure.move(moved)
+        renamed = set()
+        for records, values in zip(args[::2], args[1::2]):
+            if set(SEARCH_KEY_FIELDS + ['party']) & set(values):
+                renamed.update(records)
+        if renamed:
+            cls._update_search_key(list(renamed))
+
+    @classmethod
+    def _get_party_names(cls, party_ids):
+        Party = Pool().get('party.party')
+        return dict((p.id, p.name) for p in Party.browse(list(set(party_ids))))
+
+    @classmethod
+    def _update_search_key(cls, employees):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        rows = cls.read([e.id for e in employees], SEARCH_KEY_FIELDS + ['party'])
+        party_names = cls._get_party_names([r['party'] for r in rows if r['party']])
+        for values in rows:
+            key = make_search_key(values, party_names.get(values['party']))
+            cursor.execute(*table.update([table.search_key], [key], where=table.id == values['id']))
+
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        _, operator, value = clause[:3]
+        if operator not in ('like', 'ilike') or not value:
+            return super(Employee, cls).search_rec_name(name, clause)
+        text = value.strip('%').strip()
+        # Every word must appear in the key, which the trigram index serves
+        words = [w for w in text.lower().split() if w.strip('%')]
+        return ['OR',
+            ('employee_id', '=', text),
+            [('search_key', 'like', '%' + w.strip('%') + '%') for w in words],
+            ]
+
+    @classmethod
+    def autocomplete(cls, text, limit=10):
+        """
+            Return the ids and names of the employees matching the text, the
+            exact employee id first, then the ids and names starting with it
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        text = text.strip()
+        if not text:
+            return []
+        query = cls.search([('rec_name', 'ilike', '%' + text + '%')], query=True)
+        key = text.lower()
+        rank = Case((table.employee_id == text, 0),
+            (table.search_key.like(key + '%'), 1),
+            (table.search_key.like('% ' + key + '%'), 2),
+            else_=3)
+        cursor.execute(*table.select(table.id, where=table.id.in_(query),
+                order_by=[rank, table.employee_id], limit=limit))
+        employees = cls.browse([x for x, in cursor.fetchall()])
+        return [(e.id, e.rec_name) for e in employees]
+
+    @classmethod
+    def delete(cls, employees):
+        EmployeeClosure = Pool().get('company.employee.closure')
+        ids = [e.id for e in employees]
+        # The reports lose their manager, so also the managers above it
+        reports = cls.search([('manager', 'in', ids), ('id', 'not in', ids)])
+        super(Employee, cls).delete(employees)
+        if reports:
+            EmployeeClosure.move(reports)
+
+    @classmethod
+    def _revision_fields(cls):
+        """Return the names of the fields recorded in the employee history"""
+        History = Pool().get('company.employee.history')
+        # Binaries kept in the filestore are recorded by their file id
+        return [name for name, field in History._fields.iteritems()
+            if name in cls._fields and not hasattr(cls._fields[name], 'set')
+            and not getattr(cls._fields[name], 'file_id', None)
+            and name not in ('id', 'create_uid', 'create_date', 'write_uid', 'write_date', 'rec_name')]
+
+    @classmethod
+    def get_state_at(cls, employees, timestamp):
+        """
+            Rebuild from the revisions the values of the employees' history
+            fields at the timestamp
+        """
+        EmployeeRevision = Pool().get('company.employee.revision')
+        states = dict((e.id, {}) for e in employees)
+        for revision in EmployeeRevision.search([
+                    ('employee', 'in', [e.id for e in employees]),
+                    ('date', '<=', timestamp),
+                    ], order=[('date', 'ASC'), ('id', 'ASC')]):
+            states[revision.employee.id].update(revision.get_changes())
+        return states
 
     @classmethod
     def copy(cls, employees, default=None):
@@ -175,130 +691,172 @@ class Employee(ModelSQL, ModelView):
         default['employee_id'] = None
         return super(Employee, cls).copy(employees, default=default)
 
-    def get_current_payrollyear(self):
+    @classmethod
+    def get_current_payrollyear(cls, employees, name):
         PayrollYear = Pool().get('payroll.year')
         Date3 = Pool().get('ir.date')
-        date = Date3.today()
-        years = PayrollYear.search([('state', '=', 'open'), ('start_date', '<=', date), ('end_date', '>=', date), ])
-        if not years or (len(years) > 1):
-            self.raise_user_error('payrollyear_not_found')
-        return years[0].id
+        # Today in the timezone of each employee's company
+        dates = Date3.today_by_company(list(set(e.company.id for e in employees)))
+        return dict((employee.id, PayrollYear.find(employee.company.id,
+                        employee.department.id if employee.department else None, dates[employee.company.id]))
+            for employee in employees)
 
-    def get_addresses(self):
-        # Return all the addresses of the party as the address of the employee
-        return map(int, self.party.addresses)
+    @classmethod
+    def get_managers(cls, employees, name):
+        EmployeeClosure = Pool().get('company.employee.closure')
+        return EmployeeClosure.get_chains([e.id for e in employees])
+
+    @classmethod
+    def search_managers(cls, name, clause):
+        # The employees reporting directly or not to the managers
+        EmployeeClosure = Pool().get('company.employee.closure')
+        closure = EmployeeClosure.__table__()
+        name, operator, value = clause[:3]
+        if '.' in name:
+            nested = name.split('.', 1)[1]
+            operator, value = 'in', cls.search([(nested, operator, value)], query=True)
+        elif operator not in ('=', '!=', 'in', 'not in') or isinstance(value, basestring):
+            operator, value = 'in', cls.search([('rec_name', operator, value)], query=True)
+        if value is None:
+            # Employees without manager are the ones missing from the reports
+            return [('id', 'not in' if operator == '=' else 'in',
+                    closure.select(closure.descendant, where=closure.depth > 0))]
+        Operator = fields.SQL_OPERATORS['in' if operator in ('in', 'not in') else '=']
+        reports = closure.select(closure.descendant, where=Operator(closure.ancestor, value) & (closure.depth > 0))
+        return [('id', 'not in' if operator in ('!=', 'not in') else 'in', reports)]
+
+    @classmethod
+    def get_span_of_control(cls, employees, name):
+        EmployeeClosure = Pool().get('company.employee.closure')
+        reports = EmployeeClosure.get_subordinates([e.id for e in employees], max_depth=1)
+        return dict((i, len(r)) for i, r in reports.iteritems())
 
-    def calculate_leaves(self, types):
+    @classmethod
+    def get_available_leaves(cls, employees, names):
         """
-            Calculate leaves as per given type
-                  param types: Type for which leaves have to be calculated
+            Calculate remaining leaves in current payroll year for all the
+            employees from the leave ledger
         """
-        leaves = 0
-        for attendance in self.attendance:
-            if (self.current_payrollyear.start_date <= attendance.date) and\
-                    (attendance.date <= self.current_payrollyear.end_date):
-                if attendance.on_leave and\
-                        (attendance.leave_application.leave_type == types):
-                    leaves += 1
-        return leaves
-
-    def get_available_cl(self):
-        """Calculate remaining casual leaves in current payroll year"""
-        LeaveConfig = Pool().get('employee.leave.configuration')
-        config = LeaveConfig(1)
-        cl_taken = self.calculate_leaves('casual')
-        if self.types == 'probation':
-            allowed_cl = config.probation_cl or 0
-        else:
-            allowed_cl = config.confirmed_cl or 0
-        return allowed_cl - cl_taken
-
-    def get_available_sl(self):
-        """Calculate remaining sick leaves in current payroll year"""
-        LeaveConfig = Pool().get('employee.leave.configuration')
-        config = LeaveConfig(1)
-        sl_taken = self.calculate_leaves('sick')
-        if self.types == 'probation':
-            allowed_sl = config.probation_sl or 0
-        else:
-            allowed_sl = config.confirmed_sl or 0
-        return allowed_sl - sl_taken
-
-    def get_available_el(self):
-        """Calculate remaining earned leaves in current payroll year"""
-        LeaveConfig = Pool().get('employee.leave.configuration')
-        config = LeaveConfig(1)
-        el_taken = self.calculate_leaves('earned')
-        if self.types == 'probation':
-            allowed_el = config.probation_el or 0
-        else:
-            allowed_el = config.confirmed_el or 0
-        return allowed_el - el_taken
-
-    def get_available_dl(self):
-        """Calculate remaining study leaves in current payroll year"""
-        LeaveConfig = Pool().get('employee.leave.configuration')
-        config = LeaveConfig(1)
-        dl_taken = self.calculate_leaves('study')
-        if self.types == 'probation':
-            allowed_dl = config.probation_dl or 0
-        else:
-            allowed_dl = config.confirmed_dl or 0
-        return allowed_dl - dl_taken
-
-    def get_available_pl(self):
-        """Calculate remaining paternity leaves in current payroll year"""
-        LeaveConfig = Pool().get('employee.leave.configuration')
-        config = LeaveConfig(1)
-        pl_taken = self.calculate_leaves('paternity')
-        if self.types == 'probation':
-            allowed_pl = config.probation_pl or 0
-        else:
-            allowed_pl = config.confirmed_pl or 0
-        return allowed_pl - pl_taken
-
-    def get_available_al(self):
-        """Calculate remaining annual leaves in current payroll year"""
-        LeaveConfig = Pool().get('employee.leave.configuration')
-        config = LeaveConfig(1)
-        al_taken = self.calculate_leaves('annual')
-        if self.types == 'probation':
-            allowed_al = config.probation_al or 0
-        else:
-            allowed_al = config.confirmed_al or 0
-        return allowed_al - al_taken
+        pool = Pool()
+        LeaveLedger = pool.get('employee.leave.ledger')
+        LeavePolicy = pool.get('employee.leave.policy')
+
+        years = cls.get_current_payrollyear(employees, 'current_payrollyear')
+        taken = LeaveLedger.get_taken(years)
+        allowed = LeavePolicy.get_entitlements(employees, [LEAVE_TYPES[n] for n in names])
+
+        result = {}
+        for name in names:
+            leave_type = LEAVE_TYPES[name]
+            result[name] = {}
+            for employee in employees:
+                key = (employee.id, leave_type)
+                result[name][employee.id] = allowed[key] - taken[key]
+        return result
 
     @classmethod
-    def set_addresses(cls, records, value=None):
-        # Set the address as the address of the party
-        Party2 = Pool().get('party.party')
-        for record in records:
-            Party2.write([record.party], {'addresses': value})
+    def search_age(cls, name, clause):
+        """Search on the age in full years through the date of birth"""
+        Date = Pool().get('ir.date')
+        _, operator, value = clause[:3]
+        if value is None:
+            return [('date_of_birth', '=', None)]
+        # Accept 30, '30', '30y' or the '%30%' of a like
+        text = ('%s' % value).strip('% ').split('y')[0].strip()
+        if not text.isdigit():
+            return [('id', '=', None)]
+        years = int(text)
+        today = Date.today()
+
+        def born(years):
+            # Latest date of birth to be at least that old today
+            return today - relativedelta(years=years)
+        if operator in ('=', 'like', 'ilike'):
+            return [('date_of_birth', '<=', born(years)), ('date_of_birth', '>', born(years + 1))]
+        elif operator in ('!=', 'not like', 'not ilike'):
+            return ['OR', ('date_of_birth', '>', born(years)), ('date_of_birth', '<=', born(years + 1))]
+        elif operator == '>=':
+            return [('date_of_birth', '<=', born(years))]
+        elif operator == '>':
+            return [('date_of_birth', '<=', born(years + 1))]
+        elif operator == '<=':
+            return [('date_of_birth', '>', born(years + 1))]
+        elif operator == '<':
+            return [('date_of_birth', '>', born(years))]
+        return [('id', '=', None)]
+
+    @classmethod
+    def order_age(cls, tables):
+        # The date of birth as a number negated, so the older the greater
+        table, _ = tables[None]
+        birth = table.date_of_birth
+        return [-(Extract('YEAR', birth) * 10000 + Extract('MONTH', birth) * 100 + Extract('DAY', birth))]
+
+    @classmethod
+    def _get_party_records(cls, employees, model_name):
+        """
+            Return for each employee the ids of the active records of the
+            model linked to its party, with one query per slice of parties
+        """
+        Model = Pool().get(model_name)
+        table = Model.__table__()
+        cursor = Transaction().connection.cursor()
+        employee_ids = defaultdict(list)
+        for employee in employees:
+            employee_ids[employee.party.id].append(employee.id)
+        result = dict((e.id, []) for e in employees)
+        for sub_ids in grouped_slice(list(employee_ids)):
+            cursor.execute(*table.select(table.party, table.id,
+                    where=reduce_ids(table.party, sub_ids) & (table.active == True),
+                    order_by=[table.sequence, table.id]))
+            for party_id, record_id in cursor.fetchall():
+                for employee_id in employee_ids[party_id]:
+                    result[employee_id].append(record_id)
+        return result
 
-        def get_contact_mechanisms(self, name):
-            #  Return all the contact_mechanisms of the party as the
-            #     contact_mechanism of the employee
+    @classmethod
+    def get_addresses(cls, employees, name):
+        # Return all the addresses of the party as the address of the employee
+        return cls._get_party_records(employees, 'party.address')
 
-            return map(int, self.party.contact_mechanisms)
+    @classmethod
+    def get_contact_mechanisms(cls, employees, name):
+        # Return all the contact mechanisms of the party as the contact
+        # mechanisms of the employee
+        return cls._get_party_records(employees, 'party.contact_mechanism')
 
     @classmethod
-    def set_contact_mechanisms(cls, records, name, value=None):
+    def set_addresses(cls, records, name, value):
+        # Set the address as the address of the party
+        Party = Pool().get('party.party')
+        if value:
+            Party.write(list(set(r.party for r in records)), {'addresses': value})
 
-        #   Set the contact_mechanism as the contact_mechanism of the party
-        Party1 = Pool().get('party.party')
-        for record in records:
-            Party1.write([record.party], {'contact_mechanisms': value})
+    @classmethod
+    def set_contact_mechanisms(cls, records, name, value):
+        # Set the contact mechanism as the contact mechanism of the party
+        Party = Pool().get('party.party')
+        if value:
+            Party.write(list(set(r.party for r in records)), {'contact_mechanisms': value})
 
-        def get_age(self, name=None):
-            #  Retrun age of employee
-            now = datetime.now()
-            delta = relativedelta(now, self.date_of_birth)
-            years_months_days = str(delta.years) + 'y ' + str(delta.months) + 'm ' + str(delta.days) + 'd'
-            return years_months_days
+    @staticmethod
+    def _format_age(date_of_birth, today):
+        delta = relativedelta(today, date_of_birth)
+        return '%sy %sm %sd' % (delta.years, delta.months, delta.days)
 
-        def on_change_with_age(self):
-            if self.date_of_birth:
-                return self.get_age()
+    @classmethod
+    def get_age(cls, employees, name):
+        # Return age of employee
+        Date = Pool().get('ir.date')
+        today = Date.today()
+        return dict((e.id, cls._format_age(e.date_of_birth, today) if e.date_of_birth else None)
+            for e in employees)
+
+    @fields.depends('date_of_birth')
+    def on_change_with_age(self):
+        if self.date_of_birth:
+            Date = Pool().get('ir.date')
+            return self._format_age(self.date_of_birth, Date.today())
 
     @property
     def default_marital_status(self):
@@ -361,7 +919,7 @@ class Team(ModelSQL, ModelView):
     description = fields.Text('Description')
 
 
-class TransferProposal(Workflow, ModelSQL, ModelView):
+class TransferProposal(Instrumented, Workflow, ModelSQL, ModelView):
     """Employee Promotion and Transfer Proposal"""
     __name__ = 'employee.transfer.proposal'
     _rec_name = 'employee'
@@ -387,6 +945,9 @@ class TransferProposal(Workflow, ModelSQL, ModelView):
         cls._buttons.update({'review': {'invisible': Eval('state') != 'Draft', },
                              'approve': {'invisible': Eval('state') != 'In Review', },
                              'reject': {'invisible': Eval('state') != 'In Review', }})
+        cls._error_messages.update({'transfer_failed': 'The transfer of "%(employee)s" failed: %(error)s',
+                                    'duplicate_transfer': 'Another proposal of the same run transfers the employee.'})
+        cls.__rpc__.update({'approve_all': RPC(readonly=False, instantiate=0)})
 
     @classmethod
     @ModelView.button
@@ -398,10 +959,67 @@ class TransferProposal(Workflow, ModelSQL, ModelView):
     @ModelView.button
     @Workflow.transition('Approved')
     def approve(cls, proposals):
-        Employee2 = Pool().get('company.employee')
+        outcomes = cls.transfer(proposals)
         for proposal in proposals:
-            Employee2.write([proposal.employee], {'company': proposal.proposed_company.id,
-                                                  'department': proposal.proposed_department.id, })
+            if outcomes[proposal.id]:
+                cls.raise_user_error('transfer_failed', {'employee': proposal.employee.rec_name,
+                                                         'error': outcomes[proposal.id]})
+
+    @classmethod
+    def approve_all(cls, proposals):
+        """
+            Approve the proposals in review whose transfer succeeds and return
+            the list of (proposal id, None or the reason it was not approved)
+        """
+        proposals = [p for p in proposals if p.state == 'In Review']
+        outcomes = cls.transfer(proposals)
+        approved = [p for p in proposals if not outcomes[p.id]]
+        if approved:
+            cls.write(approved, {'state': 'Approved'})
+        return [(p.id, outcomes[p.id]) for p in proposals]
+
+    @classmethod
+    def transfer(cls, proposals):
+        """
+            Move the employees to the proposed company and department with one
+            write per target and return for each proposal None or the error.
+            When a group fails, its proposals are retried one by one to find
+            the failing ones
+        """
+        Employee = Pool().get('company.employee')
+        cursor = Transaction().connection.cursor()
+        outcomes = {}
+        groups = defaultdict(list)
+        employees = set()
+        for proposal in proposals:
+            if proposal.employee.id in employees:
+                outcomes[proposal.id] = cls._error_messages['duplicate_transfer']
+                continue
+            employees.add(proposal.employee.id)
+            groups[(proposal.proposed_company.id, proposal.proposed_department.id)].append(proposal)
+
+        def write(group, values):
+            # Undo only this write if it fails
+            cursor.execute('SAVEPOINT hr_transfer')
+            try:
+                Employee.write([p.employee for p in group], values)
+            except UserError as exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT hr_transfer')
+                return exception.message
+            except Exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT hr_transfer')
+                raise
+            cursor.execute('RELEASE SAVEPOINT hr_transfer')
+
+        for (company_id, department_id), group in groups.iteritems():
+            values = {'company': company_id, 'department': department_id}
+            error = write(group, values)
+            if error and len(group) > 1:
+                for proposal in group:
+                    outcomes[proposal.id] = write([proposal], values)
+            else:
+                outcomes.update((p.id, error) for p in group)
+        return outcomes
 
     @classmethod
     @ModelView.button
@@ -437,6 +1055,19 @@ class Party:
     __name__ = 'party.party'
     _history = True
 
+    @classmethod
+    def write(cls, *args):
+        super(Party, cls).write(*args)
+        actions = iter(args)
+        renamed = [p.id for parties, values in zip(actions, actions) if 'name' in values for p in parties]
+        if renamed:
+            # The party name is part of the employee search key
+            Employee = Pool().get('company.employee')
+            with Transaction().set_context(active_test=False):
+                employees = Employee.search([('party', 'in', renamed)])
+            if employees:
+                Employee._update_search_key(employees)
+
 
 class PaymentDetail(ModelSQL, ModelView):
     """Payment Detail"""
@@ -461,7 +1092,7 @@ class PaymentDetail(ModelSQL, ModelView):
         return 'cash'
 
 
-class EmployeeHistory(ModelSQL, ModelView):
+class EmployeeHistory(Instrumented, ModelSQL, ModelView):
     """Employee History"""
     __name__ = 'company.employee.history'
     _rec_name = 'employee'
@@ -471,7 +1102,8 @@ class EmployeeHistory(ModelSQL, ModelView):
     party = fields.Many2One('party.party', 'Party', datetime_field='date')
     company = fields.Many2One('company.company', 'Company', datetime_field='date')
     department = fields.Many2One('company.department', 'Department', datetime_field='date')
-    photo = fields.Binary('Photo')
+    photo = fields.Binary('Photo', file_id='photo_id')
+    photo_id = fields.Char('Photo ID')
     state = fields.Selection([('current', 'Current'), ('retired', 'Retired'), ('closed', 'Closed'), ], 'State')
     first_name = fields.Char('First Name')
     middle_name = fields.Char('Middle Name')
@@ -501,32 +1133,298 @@ class EmployeeHistory(ModelSQL, ModelView):
     def __setup__(cls):
         super(EmployeeHistory, cls).__setup__()
         cls._order.insert(0, ('date', 'DESC'))
+        cls.__rpc__.update({'get_page': RPC()})
 
     @classmethod
-    def _table_query_fields(cls):
+    def table_query(cls):
+        if HISTORY_MODE == 'delta':
+            return cls._table_query_delta()
         Employee1 = Pool().get('company.employee')
-        table = '%s__history' % Employee1._table
-        return ['MIN("%s".__id) AS id' % table, '"%s".id AS employee' % table,
-                ('MIN(COALESCE("%s".write_date, "%s".create_date)) AS date' % (table, table)),
-                ('COALESCE("%s".write_uid, "%s".create_uid) AS user' % (table, table)), ] + ['"%s"."%s"' % (table, name)
-            for name, field in cls._fields.iteritems()
-                if name not in ('id', 'employee', 'date', 'user') and not hasattr(field, 'set')]
+        history = Employee1.__table_history__()
+        revision = Employee1.__table_history__()
+        date = Coalesce(revision.write_date, revision.create_date)
+        where = Literal(True)
+        # Restrict to the employee before grouping when it is known
+        if Transaction().context.get('history_employee'):
+            where = revision.id == Transaction().context['history_employee']
+        # One revision per employee and change date, the binary and other
+        # columns are joined back by __id instead of being grouped
+        revisions = revision.select(Min(Column(revision, '__id')).as_('id'), revision.id.as_('employee'),
+            where=where, group_by=[revision.id, date])
+        columns = [Column(history, '__id').as_('id'), history.id.as_('employee'),
+            Coalesce(history.write_date, history.create_date).as_('date'),
+            Coalesce(history.write_uid, history.create_uid).as_('user'),
+            history.create_uid, history.create_date, history.write_uid, history.write_date,
+            ] + [Column(history, name).as_(name) for name, field in cls._fields.iteritems()
+                if name not in ('id', 'employee', 'date', 'user', 'create_uid', 'create_date', 'write_uid',
+                                'write_date', 'rec_name') and not hasattr(field, 'set')]
+        return history.join(revisions, condition=(Column(history, '__id') == revisions.id)
+            & (history.id == revisions.employee)).select(*columns)
 
     @classmethod
-    def _table_query_group(cls):
-        Employee5 = Pool().get('company.employee')
-        table = '%s__history' % Employee5._table
-        return ['"%s".id' % table, 'COALESCE("%s".write_uid, "%s".create_uid)' % (table, table), ] +\
-               ['"%s"."%s"' % (table, name)
-            for name, field in cls._fields.iteritems()
-                if name not in ('id', 'employee', 'date', 'user') and not hasattr(field, 'set')]
+    def _table_query_delta(cls):
+        # One row per revision, the field values are rebuilt on read
+        EmployeeRevision = Pool().get('company.employee.revision')
+        revision = EmployeeRevision.__table__()
+        where = Literal(True)
+        if Transaction().context.get('history_employee'):
+            where = revision.employee == Transaction().context['history_employee']
+        columns = [revision.id, revision.employee, revision.date, revision.user,
+            revision.create_uid, revision.create_date, revision.write_uid, revision.write_date,
+            ] + [Literal(None).as_(name) for name, field in cls._fields.iteritems()
+                if name not in ('id', 'employee', 'date', 'user', 'create_uid', 'create_date', 'write_uid',
+                                'write_date', 'rec_name') and not hasattr(field, 'set')]
+        return revision.select(*columns, where=where)
 
     @classmethod
-    def table_query1(cls):
-        # type: () -> object
-        Employee4 = Pool().get('company.employee')
-        return (('SELECT ' + (', '.join(cls._table_query_fields())) + ' FROM "%s__history" GROUP BY ' +
-                 (', '.join(cls._table_query_group()))) % Employee4._table, [])
+    def read(cls, ids, fields_names=None):
+        result = super(EmployeeHistory, cls).read(ids, fields_names=fields_names)
+        if HISTORY_MODE != 'delta':
+            return result
+        EmployeeRevision = Pool().get('company.employee.revision')
+        states = EmployeeRevision.get_states(EmployeeRevision.browse(ids))
+        for row in result:
+            state = states.get(row['id'], {})
+            for name in row.keys():
+                if name in state:
+                    row[name] = state[name]
+                elif '.' in name and name.split('.', 1)[0] in state:
+                    # Related values such as party.rec_name of the rebuilt value
+                    base, nested = name.split('.', 1)
+                    Target = cls._fields[base].get_target()
+                    row[name] = getattr(Target(state[base]), nested) if state[base] is not None else None
+        return result
+
+    @classmethod
+    def get_page(cls, employee_id, after=None, limit=50):
+        """
+            Return the ids of the next revisions of the employee, newest
+            first, following the (date, id) of the last one already read
+        """
+        domain = [('employee', '=', employee_id)]
+        if after:
+            date, id_ = after
+            domain.append(['OR', ('date', '<', date), [('date', '=', date), ('id', '<', id_)]])
+        with Transaction().set_context(history_employee=employee_id):
+            return [h.id for h in cls.search(domain, order=[('date', 'DESC'), ('id', 'DESC')], limit=limit)]
+
+
+class EmployeeRevision(ModelSQL, ModelView):
+    """Employee Revision"""
+    __name__ = 'company.employee.revision'
+    _rec_name = 'employee'
+    employee = fields.Many2One('company.employee', 'Employee', required=True, select=True, readonly=True,
+                               ondelete='CASCADE')
+    date = fields.DateTime('Change Date', required=True, readonly=True)
+    user = fields.Many2One('res.user', 'User', readonly=True)
+    changes = fields.Text('Changes', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(EmployeeRevision, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        super(EmployeeRevision, cls).__register__(module_name)
+        table = TableHandler(cls, module_name)
+        table.index_action(['employee', 'date'], 'add')
+
+    def get_changes(self):
+        """Return the values of the fields changed by the revision"""
+        return json.loads(self.changes, object_hook=JSONDecoder())
+
+    @classmethod
+    def record(cls, before, after):
+        """
+            Create one revision per employee holding its changed values
+                  param before: dict of employee id to values read before
+                  param after: list of values read after the change
+        """
+        now = datetime.now()
+        to_create = []
+        for values in after:
+            old = before.get(values['id'], {})
+            changes = dict((name, value) for name, value in values.iteritems()
+                if name != 'id' and value != old.get(name))
+            if changes:
+                to_create.append({
+                        'employee': values['id'],
+                        'date': now,
+                        'user': Transaction().user,
+                        'changes': json.dumps(changes, cls=JSONEncoder),
+                        })
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def get_states(cls, revisions):
+        """Return the rebuilt history fields values after each of the revisions"""
+        if not revisions:
+            return {}
+        wanted = set(r.id for r in revisions)
+        states, current, employee_id = {}, {}, None
+        for revision in cls.search([
+                    ('employee', 'in', list(set(r.employee.id for r in revisions))),
+                    ('date', '<=', max(r.date for r in revisions)),
+                    ], order=[('employee', 'ASC'), ('date', 'ASC'), ('id', 'ASC')]):
+            if revision.employee.id != employee_id:
+                current, employee_id = {}, revision.employee.id
+            current.update(revision.get_changes())
+            if revision.id in wanted:
+                states[revision.id] = current.copy()
+        return states
+
+
+class EmployeeClosure(ModelSQL):
+    """Employee Reporting Chain"""
+    __name__ = 'company.employee.closure'
+    ancestor = fields.Many2One('company.employee', 'Manager', required=True, ondelete='CASCADE')
+    descendant = fields.Many2One('company.employee', 'Employee', required=True, ondelete='CASCADE')
+    # 0 for the employee itself, 1 for its manager, 2 for the manager's manager...
+    depth = fields.Integer('Depth', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(EmployeeClosure, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [('link_uniq', Unique(t, t.ancestor, t.descendant),
+                                  'An employee can appear only once in a reporting chain.')]
+        cls._error_messages.update({'recursive_managers': 'Employee "%s" can not report to one of its reports!',
+                                    'managers_cycle': 'The managers of the employees form a cycle.'})
+        cls.__rpc__.update({'rebuild': RPC(readonly=False)})
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        created = not TableHandler.table_exist(cls._table)
+        super(EmployeeClosure, cls).__register__(module_name)
+        table = TableHandler(cls, module_name)
+        table.index_action(['ancestor', 'depth'], 'add')
+        table.index_action(['descendant', 'depth'], 'add')
+        if created:
+            cls.rebuild()
+
+    @classmethod
+    def add(cls, employees):
+        "Add the new employees under their manager"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        for sub_employees in grouped_slice(employees):
+            cursor.execute(*table.insert([table.ancestor, table.descendant, table.depth, table.create_uid,
+                                          table.create_date],
+                    [[e.id, e.id, 0, transaction.user, CurrentTimestamp()] for e in sub_employees]))
+        cls.move([e for e in employees if e.manager])
+
+    @classmethod
+    def check_cycle(cls, employees, manager_id):
+        "Raise if the manager is one of the employees or reports to them"
+        if not manager_id:
+            return
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        for sub_ids in grouped_slice([e.id for e in employees]):
+            cursor.execute(*table.select(table.ancestor,
+                    where=reduce_ids(table.ancestor, sub_ids) & (table.descendant == manager_id), limit=1))
+            row = cursor.fetchone()
+            if row:
+                Employee = Pool().get('company.employee')
+                cls.raise_user_error('recursive_managers', (Employee(row[0]).rec_name,))
+
+    @classmethod
+    def move(cls, employees):
+        """
+            Detach the subtrees of the employees from their former managers
+            and attach them under their current manager
+        """
+        Employee = Pool().get('company.employee')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        subtree = cls.__table__()
+        above = cls.__table__()
+        employee = Employee.__table__()
+        managers = {}
+        for sub_ids in grouped_slice(list(set(e.id for e in employees))):
+            cursor.execute(*employee.select(employee.id, employee.manager, where=reduce_ids(employee.id, sub_ids)))
+            managers.update(cursor.fetchall())
+        for employee_id, manager_id in managers.iteritems():
+            cursor.execute(*table.delete(
+                    where=table.descendant.in_(subtree.select(subtree.descendant,
+                            where=subtree.ancestor == employee_id))
+                    & table.ancestor.in_(above.select(above.ancestor,
+                            where=(above.descendant == employee_id) & (above.depth > 0)))))
+            if manager_id:
+                cursor.execute(*table.insert([table.ancestor, table.descendant, table.depth, table.create_uid,
+                                              table.create_date],
+                        above.join(subtree, condition=(above.descendant == manager_id)
+                            & (subtree.ancestor == employee_id)).select(above.ancestor, subtree.descendant,
+                            above.depth + subtree.depth + 1, Literal(transaction.user), CurrentTimestamp())))
+
+    @classmethod
+    def rebuild(cls):
+        "Recompute the whole table from the managers of the employees"
+        Employee = Pool().get('company.employee')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        closure = cls.__table__()
+        employee = Employee.__table__()
+        columns = [table.ancestor, table.descendant, table.depth, table.create_uid, table.create_date]
+        cursor.execute(*table.delete())
+        cursor.execute(*table.insert(columns, employee.select(employee.id, employee.id, Literal(0),
+                        Literal(transaction.user), CurrentTimestamp())))
+        cursor.execute(*employee.select(Count(Literal('*'))))
+        count, = cursor.fetchone()
+        depth = 0
+        while True:
+            if depth > count:
+                # Only a cycle in the managers makes chains longer than that
+                cls.raise_user_error('managers_cycle')
+            # Extend the chains found so far by one level of reports
+            cursor.execute(*table.insert(columns, closure.join(employee,
+                        condition=employee.manager == closure.descendant).select(closure.ancestor, employee.id,
+                        Literal(depth + 1), Literal(transaction.user), CurrentTimestamp(),
+                        where=closure.depth == depth)))
+            depth += 1
+            cursor.execute(*table.select(table.descendant, where=table.depth == depth, limit=1))
+            if not cursor.fetchone():
+                break
+
+    @classmethod
+    def get_subordinates(cls, employee_ids, max_depth=None):
+        """
+            Return for each employee the ids of the employees reporting to it,
+            directly or up to max_depth levels below
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        result = dict((i, []) for i in employee_ids)
+        for sub_ids in grouped_slice(employee_ids):
+            where = reduce_ids(table.ancestor, sub_ids) & (table.depth > 0)
+            if max_depth is not None:
+                where &= table.depth <= max_depth
+            cursor.execute(*table.select(table.ancestor, table.descendant, where=where,
+                    order_by=[table.ancestor, table.depth]))
+            for ancestor, descendant in cursor.fetchall():
+                result[ancestor].append(descendant)
+        return result
+
+    @classmethod
+    def get_chains(cls, employee_ids):
+        "Return for each employee the ids of its managers, the nearest first"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        result = dict((i, []) for i in employee_ids)
+        for sub_ids in grouped_slice(employee_ids):
+            cursor.execute(*table.select(table.descendant, table.ancestor,
+                    where=reduce_ids(table.descendant, sub_ids) & (table.depth > 0),
+                    order_by=[table.descendant, table.depth]))
+            for descendant, ancestor in cursor.fetchall():
+                result[descendant].append(ancestor)
+        return result
 
 
 # Amine T added the following:
@@ -565,16 +1463,104 @@ class EmployeeConfigStart(ModelView):
 class Date:
     __name__ = 'ir.date'
 
+    @classmethod
+    def _memo(cls):
+        # Timezones and dates resolved during the transaction, so a long
+        # transaction keeps the date it started with
+        return Transaction().get_cache().setdefault('ir.date.today', {'timezones': {}, 'today': {}})
+
+    @classmethod
+    def get_timezones(cls, company_ids):
+        "Return the timezone of each company, read once per transaction"
+        Company = Pool().get('company.company')
+        company = Company.__table__()
+        cursor = Transaction().connection.cursor()
+        timezones = cls._memo()['timezones']
+        missing = [i for i in set(company_ids) if i not in timezones]
+        for sub_ids in grouped_slice(missing):
+            timezones.update(dict((i, None) for i in sub_ids))
+            cursor.execute(*company.select(company.id, company.timezone, where=reduce_ids(company.id, sub_ids)))
+            timezones.update(cursor.fetchall())
+        return dict((i, timezones[i]) for i in company_ids)
+
     @classmethod
     def today(cls, timezone=None):
-        pool = Pool()
-        company = pool.get('company.company')
         company_id = Transaction().context.get('company')
         if timezone is None and company_id:
-            employee = company(company_id)
-            if company.timezone:
-                timezone =(company.timezone)
-        return super(Date, cls).today()
+            timezone = cls.get_timezones([company_id])[company_id]
+        memo = cls._memo()['today']
+        key = (company_id, timezone)
+        if key not in memo:
+            memo[key] = super(Date, cls).today(timezone=timezone)
+        return memo[key]
+
+    @classmethod
+    def today_by_company(cls, company_ids):
+        "Return the date of today in the timezone of each company"
+        memo = cls._memo()['today']
+        result = {}
+        for company_id, timezone in cls.get_timezones(company_ids).iteritems():
+            key = (company_id, timezone)
+            if key not in memo:
+                memo[key] = super(Date, cls).today(timezone=timezone)
+            result[company_id] = memo[key]
+        return result
+
+
+class ReorganizeStart(ModelView):
+    """Reorganize Departments"""
+    __name__ = 'company.department.reorganize.start'
+    source = fields.Many2One('company.department', 'Source', required=True,
+                             help='The department moved with the departments below it.')
+    target = fields.Many2One('company.department', 'Target', required=True,
+                             help='Where the employees go when no line maps their department.')
+    lines = fields.One2Many('company.department.reorganize.line', None, 'Mapping')
+    deactivate = fields.Boolean('Deactivate Source Departments')
+
+
+class ReorganizeLine(ModelView):
+    """Reorganize Departments Line"""
+    __name__ = 'company.department.reorganize.line'
+    source = fields.Many2One('company.department', 'Source', required=True)
+    target = fields.Many2One('company.department', 'Target', required=True)
+
+
+class Reorganize(Wizard):
+    """Reorganize Departments"""
+    __name__ = 'company.department.reorganize'
+    start = StateView('company.department.reorganize.start',
+                      'hr.department_reorganize_start_view_form',
+                      [Button('Cancel', 'end', 'tryton-cancel'),
+                       Button('Reorganize', 'reorganize', 'tryton-ok', default=True), ])
+    reorganize = StateTransition()
+
+    def default_start(self, fields):
+        context = Transaction().context
+        if context.get('active_model') == 'company.department':
+            return {'source': context.get('active_id')}
+        return {}
+
+    def transition_reorganize(self):
+        pool = Pool()
+        Department = pool.get('company.department')
+        PayrollYear = pool.get('payroll.year')
+        with Transaction().set_context(active_test=False):
+            subtree = Department.search([('path', 'like', self.start.source.path + '%')])
+        # The line of the nearest mapped department up the tree wins
+        lines = dict((l.source.path, l.target.id) for l in self.start.lines)
+        mapping = {}
+        for department in subtree:
+            prefixes = [p for p in lines if department.path.startswith(p)]
+            mapping[department.id] = lines[max(prefixes, key=len)] if prefixes else self.start.target.id
+        Department.reorganize(mapping)
+        if self.start.deactivate:
+            # Keep the targets and any department still owning payroll years
+            owners = set(y.department.id for y in PayrollYear.search([
+                            ('department', 'in', [d.id for d in subtree])]))
+            to_deactivate = [d for d in subtree if d.id not in mapping.values() and d.id not in owners]
+            if to_deactivate:
+                Department.write(to_deactivate, {'active': False})
+        return 'end'
 
 
 class EmployeeConfig(Wizard):
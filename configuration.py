@@ -5,9 +5,21 @@
 # :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
 # :license: BSD, see LICENSE for more details.
 
+from trytond import backend
+from trytond.cache import Cache
 from trytond.model import ModelView, ModelSQL, ModelSingleton, fields
-__all__ = ['LeaveConfiguration']
-      
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from .company import LEAVE_TYPES
+from .instrument import Instrumented
+__all__ = ['LeaveConfiguration', 'LeavePolicy']
+
+# Compiled leave policies per company, see LeavePolicy.compile
+_policy_cache = Cache('employee.leave.policy', context=False)
+
+EMPLOYEE_TYPES = [(None, ''), ('probation', 'Probation'), ('confirmed', 'Confirmed')]
+
 
 class LeaveConfiguration(ModelSingleton, ModelSQL, ModelView):
     """Leave Configuration"""
@@ -25,6 +37,17 @@ class LeaveConfiguration(ModelSingleton, ModelSQL, ModelView):
     confirmed_pl = fields.Integer('Confirmed Paternity Leaves')
     confirmed_al = fields.Integer('Confirmed Annual Leaves')
 
+    @classmethod
+    def create(cls, vlist):
+        records = super(LeaveConfiguration, cls).create(vlist)
+        _policy_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(LeaveConfiguration, cls).write(*args)
+        _policy_cache.clear()
+
     @staticmethod
     def default_probation_cl():
         return 5
@@ -72,3 +95,127 @@ class LeaveConfiguration(ModelSingleton, ModelSQL, ModelView):
     @staticmethod
     def default_confirmed_al():
         return 0
+
+
+class LeavePolicy(Instrumented, ModelSQL, ModelView):
+    """Leave Policy"""
+    __name__ = 'employee.leave.policy'
+    company = fields.Many2One('company.company', 'Company', required=True, select=True)
+    department = fields.Many2One('company.department', 'Department', domain=[('company', '=', Eval('company'))],
+                                 ondelete='CASCADE', depends=['company'],
+                                 help='Applies to the department and the ones below it.')
+    employee_type = fields.Selection(EMPLOYEE_TYPES, 'Employee Type', help='Leave empty for all types.')
+    leave_type = fields.Selection('get_leave_types', 'Leave Type', required=True)
+    entitlement = fields.Integer('Entitlement', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(LeavePolicy, cls).__setup__()
+        # A unique constraint would not see the empty department and type
+        cls._constraints += [('check_unique', 'duplicate_policy')]
+        cls._error_messages.update({'duplicate_policy': 'There can be only one entitlement per leave type, '
+                                                        'department and employee type.'})
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        super(LeavePolicy, cls).__register__(module_name)
+        # Migration from the unique constraint
+        TableHandler(cls, module_name).drop_constraint('policy_uniq')
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def get_leave_types(cls):
+        # The same leave types as the leave applications
+        return Pool().get('employee.leave.application').leave_type.selection
+
+    def check_unique(self):
+        """Check no other policy has the same leave type, department and employee type"""
+        return not self.search([
+                ('id', '!=', self.id),
+                ('company', '=', self.company.id),
+                ('department', '=', self.department.id if self.department else None),
+                ('employee_type', '=', self.employee_type),
+                ('leave_type', '=', self.leave_type),
+                ], limit=1)
+
+    @classmethod
+    def create(cls, vlist):
+        policies = super(LeavePolicy, cls).create(vlist)
+        _policy_cache.clear()
+        return policies
+
+    @classmethod
+    def write(cls, *args):
+        super(LeavePolicy, cls).write(*args)
+        _policy_cache.clear()
+
+    @classmethod
+    def delete(cls, policies):
+        super(LeavePolicy, cls).delete(policies)
+        _policy_cache.clear()
+
+    @classmethod
+    def clear_cache(cls):
+        _policy_cache.clear()
+
+    @classmethod
+    def compile(cls, company_id):
+        """
+            Return the policies of the company as a lookup table
+            {(department id, employee type, leave type): entitlement}, with
+            None for any department or type and the leave configuration as
+            the (None, type, leave type) fallbacks when the company has no
+            policy for any type of the leave type
+        """
+        table = _policy_cache.get(company_id)
+        if table is not None:
+            return table
+        LeaveConfig = Pool().get('employee.leave.configuration')
+        config = LeaveConfig(1)
+        table = {}
+        for policy in cls.search([('company', '=', company_id)]):
+            key = (policy.department.id if policy.department else None, policy.employee_type, policy.leave_type)
+            table[key] = policy.entitlement
+        for name, leave_type in LEAVE_TYPES.iteritems():
+            if (None, None, leave_type) in table:
+                continue
+            code = name[len('available_'):]
+            for employee_type in ('probation', 'confirmed'):
+                table.setdefault((None, employee_type, leave_type),
+                    getattr(config, '%s_%s' % (employee_type, code)) or 0)
+        _policy_cache.set(company_id, table)
+        return table
+
+    @classmethod
+    def get_entitlements(cls, employees, leave_types):
+        """
+            Return {(employee id, leave type): entitlement} resolved from the
+            most specific policy: the nearest department up the tree first,
+            then the employee type before any type
+        """
+        tables = {}
+        result = {}
+        for employee in employees:
+            company_id = employee.company.id
+            if company_id not in tables:
+                tables[company_id] = cls.compile(company_id)
+            table = tables[company_id]
+            employee_type = 'probation' if employee.types == 'probation' else 'confirmed'
+            departments = []
+            if employee.department and employee.department.path:
+                departments = [int(i) for i in reversed(employee.department.path.strip('/').split('/'))]
+            for leave_type in leave_types:
+                for department_id in departments + [None]:
+                    key = (department_id, employee_type, leave_type)
+                    if key not in table:
+                        key = (department_id, None, leave_type)
+                    if key in table:
+                        result[(employee.id, leave_type)] = table[key]
+                        break
+                else:
+                    result[(employee.id, leave_type)] = 0
+        return result
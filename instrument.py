@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# Instrumentation
+# :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
+# :license: BSD, see LICENSE for more details.
+import json
+import logging
+import threading
+import time
+from functools import wraps
+
+from trytond.config import config
+from trytond.model import ModelView, fields
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+__all__ = ['Instrumented', 'InstrumentStats']
+
+# Set instrument = True in the [hr] section to time the getters, setters,
+# searchers, constraints and buttons of the module
+INSTRUMENT = config.getboolean('hr', 'instrument', default=False)
+
+logger = logging.getLogger(__name__)
+
+# {(model, method, caller): [calls, seconds, queries, rows]} of this process
+_stats = {}
+_stats_lock = threading.Lock()
+# Instrumented calls in progress in the thread, the outermost first
+_local = threading.local()
+
+
+class CountingCursor(object):
+    """Cursor counting the statements it executes and the rows it fetches"""
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter[0] += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._counter[1] += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._counter[1] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._counter[1] += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._counter[1] += 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection(object):
+    """Connection handing out counting cursors"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.counter = [0, 0]
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self.connection.cursor(*args, **kwargs), self.counter)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def record(model, method, function, *args, **kwargs):
+    """Call the function and add its time, queries and rows to the stats"""
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    transaction = Transaction()
+    outermost = not stack
+    if outermost:
+        # The counting connection lives only for the outermost call, so the
+        # real connection goes back to the pool when the transaction stops
+        transaction.connection = CountingConnection(transaction.connection)
+    counter = transaction.connection.counter
+    caller = stack[-1] if stack else None
+    stack.append('%s.%s' % (model, method))
+    queries, rows, start = counter[0], counter[1], time.time()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        seconds = time.time() - start
+        stack.pop()
+        key = (model, method, caller)
+        with _stats_lock:
+            stat = _stats.setdefault(key, [0, 0., 0, 0])
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] += counter[0] - queries
+            stat[3] += counter[1] - rows
+        if outermost:
+            transaction.connection = transaction.connection.connection
+
+
+def wrap(model, name, function):
+    """Return the function recording its calls as the method of the model"""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        return record(model, name, function, *args, **kwargs)
+    wrapper._hr_instrumented = True
+    return wrapper
+
+
+def instrument(cls):
+    """Wrap the getters, setters, searchers, constraints and buttons of the model"""
+    names = set()
+    for field in cls._fields.itervalues():
+        if isinstance(field, fields.Function):
+            names.update(n for n in (field.getter, field.setter, field.searcher) if n)
+    names.update(method for method, _ in cls._constraints)
+    names.update(cls._buttons)
+    for name in names:
+        method = getattr(cls, name, None)
+        if method is None or getattr(method, '_hr_instrumented', False):
+            continue
+        wrapper = wrap(cls.__name__, name, method.__func__)
+        # Class methods are bound to the class, others are unbound methods
+        setattr(cls, name, classmethod(wrapper) if method.__self__ is not None else wrapper)
+
+
+def get_stats():
+    """Return the aggregated stats of the process, the slowest first"""
+    with _stats_lock:
+        items = _stats.items()
+    return sorted(({
+                'model': model,
+                'method': method,
+                'caller': caller,
+                'calls': calls,
+                'seconds': seconds,
+                'queries': queries,
+                'rows': rows,
+                } for (model, method, caller), (calls, seconds, queries, rows) in items),
+        key=lambda s: s['seconds'], reverse=True)
+
+
+class Instrumented(object):
+    """Instrument the model when the instrumentation is enabled"""
+
+    @classmethod
+    def __post_setup__(cls):
+        super(Instrumented, cls).__post_setup__()
+        if INSTRUMENT:
+            instrument(cls)
+
+
+class InstrumentStats(ModelView):
+    """HR Instrumentation Statistics"""
+    __name__ = 'hr.instrument.stats'
+
+    @classmethod
+    def __setup__(cls):
+        super(InstrumentStats, cls).__setup__()
+        # The stats are shared by all the users of the process, so reset stays server side
+        cls.__rpc__.update({
+                'get_stats': RPC(),
+                'log_stats': RPC(),
+                })
+
+    @classmethod
+    def get_stats(cls):
+        """
+            Return per model, method and caller the number of calls and the
+            total seconds, queries and rows fetched in this process
+        """
+        return get_stats()
+
+    @classmethod
+    def reset(cls):
+        with _stats_lock:
+            _stats.clear()
+
+    @classmethod
+    def log_stats(cls):
+        "Log one JSON line per stat, for log scrapers"
+        for stat in get_stats():
+            logger.info(json.dumps(stat, sort_keys=True))
@@ -2,18 +2,27 @@
 #  Payroll
 # :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
 # :license: BSD, see LICENSE for more details.
+from bisect import bisect_right
+from collections import defaultdict
 from sql.conditionals import Coalesce, Case
 from dateutil.relativedelta import relativedelta
+from trytond import backend
+from trytond.cache import Cache
 from trytond.model import ModelView, ModelSQL, fields
-from trytond.tools import datetime_strftime
+from trytond.tools import datetime_strftime, grouped_slice, reduce_ids
 from trytond.wizard import Wizard, StateView, StateTransition, StateAction, \
     Button
 from trytond.pyson import Eval, If,PYSONEncoder
 from trytond.transaction import Transaction
 from trytond.pool import Pool
 from datetime import date
+from sql import Literal
+from sql.functions import CurrentTimestamp
+from .company import ensure_extension
+from .instrument import Instrumented
 
-__all__ = ['PayrollYear', 'PayrollPeriod', 'PayrollHoliday']
+__all__ = ['PayrollYear', 'PayrollPeriod', 'PayrollHoliday',
+    'GenerateCalendarStart', 'GenerateCalendar']
 
 
 STATES = {
@@ -23,10 +32,128 @@ STATES = {
 
 DEPENDS = ['state']
 
-
-
-
-class PayrollYear(ModelSQL, ModelView):
+# Open payroll years and periods per company, see get_calendar
+_calendar_cache = Cache('payroll.calendar', context=False)
+
+
+CALENDAR_TEMPLATES = [
+    ('monthly', 'Monthly'),
+    ('semi_monthly', 'Semi-Monthly'),
+    ('bi_weekly', 'Bi-Weekly'),
+    ('weekly', 'Weekly'),
+    ]
+
+
+def calendar_periods(template, start_date, end_date):
+    """
+        Return the (start date, end date) of the periods of the template
+        between the dates, computed on day ordinals
+    """
+    start, end = start_date.toordinal(), end_date.toordinal()
+    if template in ('weekly', 'bi_weekly'):
+        boundaries = range(start, end + 1, 7 if template == 'weekly' else 14)
+    else:
+        days = (1, 16) if template == 'semi_monthly' else (1,)
+        months = range(start_date.year * 12 + start_date.month - 1, end_date.year * 12 + end_date.month)
+        boundaries = [start] + [o for o in (date(m // 12, m % 12 + 1, d).toordinal()
+                for m in months for d in days) if start < o <= end]
+    ends = [b - 1 for b in boundaries[1:]] + [end]
+    return [(date.fromordinal(s), date.fromordinal(e)) for s, e in zip(boundaries, ends)]
+
+
+def check_overlap_extension(cls):
+    """Drop the overlap exclusion of the model if btree_gist is not installed"""
+    if backend.name() == 'postgresql' and not ensure_extension('btree_gist'):
+        cls._sql_constraints = [c for c in cls._sql_constraints if c[0] != 'dates_overlap']
+
+
+def period_name(template, start_date, end_date):
+    if template == 'monthly':
+        name = datetime_strftime(start_date, '%m-%Y')
+        if name != datetime_strftime(end_date, '%m-%Y'):
+            name += ' - ' + datetime_strftime(end_date, '%m-%Y')
+        return name
+    return '%s - %s' % (datetime_strftime(start_date, '%d-%m-%Y'), datetime_strftime(end_date, '%d-%m-%Y'))
+
+
+class Intervals(object):
+    """
+        Date intervals sorted by start date, searched by bisection
+              param intervals: list of (start date, end date, id)
+    """
+
+    def __init__(self, intervals):
+        self.intervals = sorted(intervals)
+        self.starts = [i[0] for i in self.intervals]
+        # Greatest end date up to each position, to stop scanning back early
+        # when intervals overlap
+        self.max_ends = []
+        for interval in self.intervals:
+            self.max_ends.append(max(self.max_ends[-1], interval[1]) if self.max_ends else interval[1])
+
+    def find(self, date):
+        """Return the ids of the intervals containing the date"""
+        ids = []
+        i = bisect_right(self.starts, date) - 1
+        while i >= 0 and self.max_ends[i] >= date:
+            start, end, id_ = self.intervals[i]
+            if end >= date:
+                ids.append(id_)
+            i -= 1
+        return ids
+
+
+def get_calendar(company_id):
+    """
+        Return the open payroll years and periods of the company as
+        {'years': {department id: Intervals}, 'periods': {...}}
+    """
+    calendar = _calendar_cache.get(company_id)
+    if calendar is not None:
+        return calendar
+    pool = Pool()
+    PayrollYear = pool.get('payroll.year')
+    PayrollPeriod = pool.get('payroll.period')
+    year = PayrollYear.__table__()
+    period = PayrollPeriod.__table__()
+    cursor = Transaction().connection.cursor()
+
+    calendar = {}
+    cursor.execute(*year.select(year.id, year.department, year.start_date, year.end_date,
+            where=(year.company == company_id) & (year.state == 'open')))
+    calendar['years'] = cursor.fetchall()
+    cursor.execute(*period.join(year, condition=period.payroll_year == year.id
+            ).select(period.id, period.department, period.start_date, period.end_date,
+            where=(year.company == company_id) & (period.state == 'open')))
+    calendar['periods'] = cursor.fetchall()
+
+    for key, rows in calendar.items():
+        intervals = defaultdict(list)
+        for id_, department, start_date, end_date in rows:
+            intervals[department].append((start_date, end_date, id_))
+        calendar[key] = dict((d, Intervals(i)) for d, i in intervals.items())
+    _calendar_cache.set(company_id, calendar)
+    return calendar
+
+
+def find_in_calendar(key, company_id, department_id, date):
+    """
+        Return the id of the open payroll year or period (key) of the
+        department containing the date, or None if there is not exactly one.
+        An employee without department has no payroll calendar
+    """
+    if department_id is None:
+        return None
+    intervals = get_calendar(company_id)[key].get(department_id)
+    if intervals is None:
+        return None
+    ids = intervals.find(date)
+    if len(ids) != 1:
+        return None
+    return ids[0]
+
+
+class PayrollYear(Instrumented, ModelSQL, ModelView):
     'Payroll Year'
     __name__ = 'payroll.year'
     name = fields.Char('Name', required=True, depends=DEPENDS)
@@ -57,6 +184,11 @@ class PayrollYear(ModelSQL, ModelView):
     def __setup__(cls):
         super(PayrollYear, cls).__setup__()
         cls._order.insert(0, ('start_date', 'ASC'))
+        cls._constraints += [('check_dates', 'payrollyear_overlaps')]
+        if backend.name() == 'postgresql':
+            # Let the database reject overlaps committed concurrently
+            cls._sql_constraints += [('dates_overlap', 'EXCLUDE USING gist (company WITH =, department WITH =, '
+                                      'daterange(start_date, end_date, \'[]\') WITH &&)', 'payrollyear_overlaps')]
         cls._error_messages.update({'payrollyear_overlaps': 'You can not have 2 payroll years that overlap!',
                'no_Payroll_date': 'No Payroll year defined for "%s".',
                'close_error': ('You can not close Payroll year "%s" until you '
@@ -87,61 +219,142 @@ class PayrollYear(ModelSQL, ModelView):
     def default_company():
         return Transaction().context.get('company')
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        check_overlap_extension(cls)
+        super(PayrollYear, cls).__register__(module_name)
+        table = TableHandler(cls, module_name)
+        table.index_action(['company', 'department', 'start_date', 'end_date'], 'add')
 
+    @classmethod
+    def create(cls, vlist):
+        years = super(PayrollYear, cls).create(vlist)
+        _calendar_cache.clear()
+        return years
 
+    @classmethod
+    def write(cls, *args):
+        super(PayrollYear, cls).write(*args)
+        _calendar_cache.clear()
 
-    def check_dates(self):
-        transaction = Transaction()
-        connection = transaction.connection
-        transaction.database.lock(connection, self._table)
-        cursor = connection.cursor()
-        table = self.__table__()
-        cursor.execute(*table.select(table.id,
-                where=(((table.start_date <= self.start_date)
-                        & (table.end_date >= self.start_date))
-                    | ((table.start_date <= self.end_date)
-                        & (table.end_date >= self.end_date))
-                    | ((table.start_date >= self.start_date)
-                        & (table.end_date <= self.end_date)))
-                & (table.company == self.company.id)
-                & (table.id != self.id)))
-        second_id = cursor.fetchone()
-        if second_id:
-            second = self.__class__(second_id[0])
-            self.raise_user_error('payrollyear_overlaps', {
-                    'first': self.rec_name,
-                    'second': second.rec_name,
-                    })
+    @classmethod
+    def delete(cls, payrollyears):
+        super(PayrollYear, cls).delete(payrollyears)
+        _calendar_cache.clear()
 
+    @classmethod
+    def find(cls, company_id, department_id, date):
+        """Return the id of the open payroll year of the department for the date"""
+        return find_in_calendar('years', company_id, department_id, date)
 
 
 
 
+    def check_dates(self):
+        # No table lock, the index covers the query and the exclusion
+        # constraint catches concurrent overlaps on PostgreSQL
+        cursor = Transaction().connection.cursor()
+        table = self.__table__()
+        cursor.execute(*table.select(table.id,
+                where=(table.start_date <= self.end_date)
+                & (table.end_date >= self.start_date)
+                & (table.company == self.company.id)
+                & (table.department == self.department.id)
+                & (table.id != self.id), limit=1))
+        return not cursor.fetchone()
+
     @classmethod
     @ModelView.button
     def close(cls, payrollyears):
-        # Close a payroll year
-        payrollyear = Pool().get('payroll.year')
+        # Close the payroll years and all their periods
         Period = Pool().get('payroll.period')
-        i=0
-        for payrollyear in payrollyears:
-            cls.write(payrollyears, {'state': 'close'})
-            while Period in payrollyear.periods:
-                cls.write(Period, {'state': 'close'})
-                i+=i
-
-
-
+        period = Period.__table__()
+        cursor = Transaction().connection.cursor()
+        cls.check_sequence(payrollyears, 'close')
+        cls.write(payrollyears, {'state': 'close'})
+        for sub_ids in grouped_slice([y.id for y in payrollyears]):
+            cursor.execute(*period.update([period.state], ['close'],
+                    where=reduce_ids(period.payroll_year, sub_ids) & (period.state == 'open')))
+        _calendar_cache.clear()
 
     @classmethod
     @ModelView.button
     def reopen(cls, payrollyears):
         # Reopen a payroll year
+        cls.check_sequence(payrollyears, 'reopen')
         cls.write(payrollyears, {'state': 'open'})
 
+    @classmethod
+    def check_sequence(cls, payrollyears, action):
+        """
+            Check in one query that no earlier payroll year of the same
+            department stays open (close) or no later one stays closed (reopen)
+        """
+        table = cls.__table__()
+        other = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        ids = [y.id for y in payrollyears]
+        if action == 'close':
+            condition = (other.end_date < table.start_date) & (other.state == 'open')
+        else:
+            condition = (other.start_date > table.end_date) & (other.state == 'close')
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.join(other, condition=(other.company == table.company)
+                    & (other.department == table.department) & condition
+                    ).select(table.id, where=reduce_ids(table.id, sub_ids) & ~reduce_ids(other.id, ids), limit=1))
+            row = cursor.fetchone()
+            if row:
+                cls.raise_user_error('%s_error' % action, (cls(row[0]).rec_name,))
 
-
-
+    @classmethod
+    def generate(cls, departments, template, start_date, end_date, name=None):
+        """
+            Create the payroll years and their periods of the template for
+            all the departments with bulk inserts, checking overlaps once
+            for the whole batch
+        """
+        Period = Pool().get('payroll.period')
+        table = cls.__table__()
+        period = Period.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        department_ids = [d.id for d in departments]
+        if not department_ids:
+            return []
+        if name is None:
+            name = datetime_strftime(start_date, '%Y')
+
+        for sub_ids in grouped_slice(department_ids):
+            cursor.execute(*table.select(table.department,
+                    where=reduce_ids(table.department, sub_ids)
+                    & (table.start_date <= end_date) & (table.end_date >= start_date), limit=1))
+            row = cursor.fetchone()
+            if row:
+                cls.raise_user_error('payrollyear_overlaps')
+
+        columns = [table.create_uid, table.create_date, table.name, table.company, table.department,
+            table.start_date, table.end_date, table.state]
+        for sub_departments in grouped_slice(departments):
+            cursor.execute(*table.insert(columns, [[transaction.user, CurrentTimestamp(), name, d.company.id,
+                                d.id, start_date, end_date, 'open'] for d in sub_departments]))
+        years = []
+        for sub_ids in grouped_slice(department_ids):
+            cursor.execute(*table.select(table.id, table.department,
+                    where=reduce_ids(table.department, sub_ids)
+                    & (table.start_date == start_date) & (table.end_date == end_date)))
+            years.extend(cursor.fetchall())
+
+        # The periods are the same for every department
+        periods = [(period_name(template, s, e), s, e) for s, e in calendar_periods(template, start_date, end_date)]
+        columns = [period.create_uid, period.create_date, period.name, period.payroll_year, period.department,
+            period.start_date, period.end_date, period.state]
+        for sub_years in grouped_slice(years, max(1, 1000 // len(periods))):
+            cursor.execute(*period.insert(columns, [[transaction.user, CurrentTimestamp(), n, year_id,
+                                department_id, s, e, 'open']
+                            for year_id, department_id in sub_years for n, s, e in periods]))
+        _calendar_cache.clear()
+        return cls.browse([y[0] for y in years])
 
     @classmethod
     @ModelView.button
@@ -179,7 +392,7 @@ class PayrollYear(ModelSQL, ModelView):
 
 
 
-class PayrollPeriod(ModelSQL, ModelView):
+class PayrollPeriod(Instrumented, ModelSQL, ModelView):
     'Payroll Period'
     __name__ = 'payroll.period'
     name = fields.Char('Name', required=True)
@@ -204,6 +417,10 @@ class PayrollPeriod(ModelSQL, ModelView):
     def __setup__(cls):
         super(PayrollPeriod, cls).__setup__()
         cls._order.insert(0, ('start_date', 'ASC'))
+        cls._constraints += [('check_dates', 'periods_overlaps')]
+        if backend.name() == 'postgresql':
+            cls._sql_constraints += [('dates_overlap', 'EXCLUDE USING gist (payroll_year WITH =, '
+                                      'daterange(start_date, end_date, \'[]\') WITH &&)', 'periods_overlaps')]
         cls._error_messages.update({'periods_overlaps':
                 'You can not have two overlapping periods!',
                 'create_period_closed_payrollyear': ('You can not create '
@@ -234,36 +451,46 @@ class PayrollPeriod(ModelSQL, ModelView):
     def default_state():
         return 'open'
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        check_overlap_extension(cls)
+        super(PayrollPeriod, cls).__register__(module_name)
+        table = TableHandler(cls, module_name)
+        table.index_action(['payroll_year', 'start_date', 'end_date'], 'add')
+
+    @classmethod
+    def create(cls, vlist):
+        periods = super(PayrollPeriod, cls).create(vlist)
+        _calendar_cache.clear()
+        return periods
+
+    @classmethod
+    def write(cls, *args):
+        super(PayrollPeriod, cls).write(*args)
+        _calendar_cache.clear()
+
+    @classmethod
+    def find(cls, company_id, department_id, date):
+        """Return the id of the open payroll period of the department for the date"""
+        return find_in_calendar('periods', company_id, department_id, date)
+
 
 
     def check_dates(self):
-        transaction = Transaction()
-        connection = transaction.connection
-        transaction.database.lock(connection, self._table)
+        cursor = Transaction().connection.cursor()
         table = self.__table__()
-        cursor = connection.cursor()
         cursor.execute(*table.select(table.id,
-                where=(((table.start_date <= self.start_date)
-                        & (table.end_date >= self.start_date))
-                        | ((table.start_date <= self.end_date)
-                        & (table.end_date >= self.end_date))
-                        | ((table.start_date >= self.start_date)
-                        & (table.end_date <= self.end_date)))
-                        & (table.payroll_year == self.payroll_year.id)
-                        & (table.id != self.id)))
-        period_id = cursor.fetchone()
-        if period_id:
-            overlapping_period = self.__class__(period_id[0])
-            self.raise_user_error('periods_overlap', {
-                    'first': self.rec_name,
-                    'second': overlapping_period.rec_name,
-                    })
-
+                where=(table.start_date <= self.end_date)
+                & (table.end_date >= self.start_date)
+                & (table.payroll_year == self.payroll_year.id)
+                & (table.id != self.id), limit=1))
+        return not cursor.fetchone()
 
     @classmethod
     def delete(cls, periods):
-        cls._check(periods)
-        super(Period, cls).delete(periods)
+        super(PayrollPeriod, cls).delete(periods)
+        _calendar_cache.clear()
 
     @classmethod
     @ModelView.button
@@ -271,35 +498,32 @@ class PayrollPeriod(ModelSQL, ModelView):
         '''
         Close a payroll period
         '''
-        pool = Pool()
-        Period = pool.get('payroll.period')
-        for Period in periods:
-            if cls.search([
-                        ('end_date', '<=', Period.start_date),
-                        ('state', '=', 'open'),]):
-                cls.raise_user_error('close_error', (Period.name,))
-
-            # First close the Payroll to be sure
-            # it will not have new period created between.
-            cls.write([Period], {
-                'state': 'close',
-                })
-
-
-
+        table = cls.__table__()
+        other = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        ids = [p.id for p in periods]
+        # All the earlier periods of the payroll year must be closed or being closed
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.join(other, condition=(other.payroll_year == table.payroll_year)
+                    & (other.end_date < table.start_date) & (other.state == 'open')
+                    ).select(table.id, where=reduce_ids(table.id, sub_ids) & ~reduce_ids(other.id, ids), limit=1))
+            row = cursor.fetchone()
+            if row:
+                cls.raise_user_error('close_error', (cls(row[0]).name,))
+        cls.write(periods, {'state': 'close'})
 
     @classmethod
     @ModelView.button
     def reopen(cls, periods):
-        #Reopen a payroll year
+        #Reopen the periods and their payroll years
         PayrollYear = Pool().get('payroll.year')
         cls.write(periods, {'state': 'open'})
-        for period in periods:
-            PayrollYear.write([period.payroll_year], {'state': 'open'})
+        years = list(set(p.payroll_year for p in periods if p.payroll_year.state != 'open'))
+        if years:
+            PayrollYear.write(years, {'state': 'open'})
 
 
-
-class PayrollHoliday(ModelSQL, ModelView):
+class PayrollHoliday(Instrumented, ModelSQL, ModelView):
     'Payroll Holiday'
     __name__ = 'payroll.holiday'
     period = fields.Many2One('payroll.period', 'Payroll Period', required=True)
@@ -324,3 +548,35 @@ class PayrollHoliday(ModelSQL, ModelView):
             return False
         return True
 
+
+class GenerateCalendarStart(ModelView):
+    'Generate Payroll Calendar'
+    __name__ = 'payroll.calendar.generate.start'
+    name = fields.Char('Name', required=True)
+    template = fields.Selection(CALENDAR_TEMPLATES, 'Periods', required=True)
+    start_date = fields.Date('Start Date', required=True,
+        domain=[('start_date', '<=', Eval('end_date', None))], depends=['end_date'])
+    end_date = fields.Date('End Date', required=True,
+        domain=[('end_date', '>=', Eval('start_date', None))], depends=['start_date'])
+    departments = fields.Many2Many('company.department', None, None, 'Departments', required=True)
+
+    @staticmethod
+    def default_template():
+        return 'monthly'
+
+
+class GenerateCalendar(Wizard):
+    'Generate Payroll Calendar'
+    __name__ = 'payroll.calendar.generate'
+    start = StateView('payroll.calendar.generate.start',
+        'hr.payroll_calendar_generate_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Generate', 'generate', 'tryton-ok', default=True),
+            ])
+    generate = StateTransition()
+
+    def transition_generate(self):
+        PayrollYear = Pool().get('payroll.year')
+        PayrollYear.generate(self.start.departments, self.start.template,
+            self.start.start_date, self.start.end_date, self.start.name)
+        return 'end'
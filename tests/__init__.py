@@ -9,7 +9,11 @@
 import unittest
 import trytond.tests.test_tryton
 from .test_view_depends import TestViewDependsCase
-    def suite():
-        test_suite = trytond.tests.test_tryton.suite()
-        test_suite.addTests([unittest.TestLoader().loadTestsFromTestCase(TestViewDependsCase)])
-        return test_suite
+from .test_hr import HRTestCase
+
+
+def suite():
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests([unittest.TestLoader().loadTestsFromTestCase(TestViewDependsCase),
+                         unittest.TestLoader().loadTestsFromTestCase(HRTestCase)])
+    return test_suite
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+benchmark
+Benchmarks of the HR module bulk operations
+
+Run against the test database configured for trytond, SQLite in memory
+or a PostgreSQL stand-in::
+
+    DB_NAME=:memory: python -m trytond.modules.hr.tests.benchmark
+    TRYTOND_DATABASE_URI=postgresql:// DB_NAME=bench \
+        python -m trytond.modules.hr.tests.benchmark --output bench.json
+
+The timings and query counts of each path are written as JSON to --output
+so that runs can be compared.
+
+:copyright: 2017 by Amine Tedjini &amp; Consulting (P) Limited
+:license: BSD, see LICENSE for more details.
+'''
+import argparse
+import datetime
+import json
+import random
+import time
+from contextlib import contextmanager
+
+from trytond.tests.test_tryton import install_module, DB_NAME, USER, CONTEXT
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.hr.instrument import CountingConnection
+from trytond.modules.hr.tests.tools import create_calendar
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+def timed(function, *args, **kwargs):
+    '''
+    Return the wall time in seconds of calling the function
+    '''
+    start = time.time()
+    function(*args, **kwargs)
+    return time.time() - start
+
+
+@contextmanager
+def count_queries():
+    '''
+    Count the statements executed on the transaction connection
+    '''
+    transaction = Transaction()
+    connection = transaction.connection
+    transaction.connection = CountingConnection(connection)
+    try:
+        yield transaction.connection.counter
+    finally:
+        transaction.connection = connection
+
+
+def measure(function, *args, **kwargs):
+    '''
+    Return the wall time and the number of queries of calling the function
+    '''
+    with count_queries() as counter:
+        seconds = timed(function, *args, **kwargs)
+    return {'seconds': seconds, 'queries': counter[0]}
+
+
+def create_employees(company, department, count):
+    '''
+    Create count employees in the department
+    '''
+    pool = Pool()
+    Party = pool.get('party.party')
+    Employee = pool.get('company.employee')
+    parties = Party.create([{'name': 'Employee %s' % i} for i in range(count)])
+    return Employee.create([{
+                'party': party.id,
+                'company': company.id,
+                'department': department.id,
+                'employee_id': 'E%06d' % i,
+                'first_name': 'First %s' % i,
+                'last_name': 'Last %s' % i,
+                } for i, party in enumerate(parties)])
+
+
+def create_leave_applications(employees, count, days, year=2017):
+    '''
+    Create count leave applications of days days, ready to be approved
+    '''
+    LeaveApplication = Pool().get('employee.leave.application')
+    start = datetime.date(year, 1, 2)
+    vlist = []
+    for i in range(count):
+        # Spread the applications so no two of an employee overlap
+        employee = employees[i % len(employees)]
+        from_date = start + datetime.timedelta((i // len(employees)) * (days + 1))
+        vlist.append({
+                'employee': employee.id,
+                'from_date': from_date,
+                'to_date': from_date + datetime.timedelta(days - 1),
+                'leave_type': 'casual',
+                'state': 'In Review',
+                })
+    return LeaveApplication.create(vlist)
+
+
+def benchmark_leave_approve(applications=1000, days=5):
+    '''
+    Compare creating the leave days one attendance at a time with the
+    batched LeaveApplication.approve
+    '''
+    pool = Pool()
+    Department = pool.get('company.department')
+    Attendance = pool.get('employee.attendance')
+    LeaveApplication = pool.get('employee.leave.application')
+    transaction = Transaction()
+    results = {}
+    for mode in ('single', 'batch'):
+        company = create_company()
+        with set_company(company):
+            department, = Department.create([{'name': 'Department', 'company': company.id}])
+            create_calendar(company, department)
+            employees = create_employees(company, department, 200)
+            apps = create_leave_applications(employees, applications, days)
+            if mode == 'single':
+                def approve(apps):
+                    for app in apps:
+                        for n in range(days):
+                            Attendance.create([{
+                                        'employee': app.employee.id,
+                                        'date': app.from_date + datetime.timedelta(n),
+                                        'on_leave': True,
+                                        'leave_application': app.id,
+                                        }])
+            else:
+                approve = LeaveApplication.approve
+            results[mode] = timed(approve, apps)
+        transaction.rollback()
+    results['speedup'] = results['single'] / results['batch']
+    return results
+
+
+def benchmark_employee_create(count=10000):
+    '''
+    Compare allocating the employee ids one sequence call at a time with
+    reserving them as one block, then create the employees in one call
+    '''
+    pool = Pool()
+    Sequence = pool.get('ir.sequence')
+    SequenceType = pool.get('ir.sequence.type')
+    Employee = pool.get('company.employee')
+    Party = pool.get('party.party')
+    transaction = Transaction()
+    results = {}
+    SequenceType.create([{'name': 'Employee', 'code': 'company.employee'}])
+    sequence, = Sequence.create([{'name': 'Employee', 'code': 'company.employee', 'padding': 6}])
+    results['single'] = timed(lambda: [Sequence.get_id(sequence.id) for _ in range(count)])
+    results['block'] = timed(Employee._reserve_employee_ids, sequence, count)
+    results['speedup'] = results['single'] / results['block']
+
+    company = create_company()
+    with set_company(company):
+        parties = Party.create([{'name': 'Employee %s' % i} for i in range(count)])
+        codes = Employee._reserve_employee_ids(sequence, count)
+        results['create'] = timed(Employee.create, [{
+                        'party': party.id,
+                        'company': company.id,
+                        'employee_id': code,
+                        } for party, code in zip(parties, codes)])
+    transaction.rollback()
+    return results
+
+
+def benchmark_transfer_approve(proposals=5000, departments=50):
+    '''
+    Compare approving the transfer proposals one employee write at a time
+    with the grouped TransferProposal.approve_all
+    '''
+    pool = Pool()
+    Department = pool.get('company.department')
+    Employee = pool.get('company.employee')
+    TransferProposal = pool.get('employee.transfer.proposal')
+    transaction = Transaction()
+    results = {}
+    for mode in ('single', 'grouped'):
+        company = create_company()
+        with set_company(company):
+            targets = Department.create([{'name': 'Department %s' % i, 'company': company.id}
+                    for i in range(departments)])
+            employees = create_employees(company, targets[0], proposals)
+            props = TransferProposal.create([{
+                        'employee': employee.id,
+                        'proposed_company': company.id,
+                        'proposed_department': targets[i % departments].id,
+                        'proposed_allowance': 0,
+                        'proposed_doj': datetime.date(2017, 1, 1),
+                        'state': 'In Review',
+                        } for i, employee in enumerate(employees)])
+            if mode == 'single':
+                def approve(props):
+                    for prop in props:
+                        Employee.write([prop.employee], {'company': prop.proposed_company.id,
+                                'department': prop.proposed_department.id})
+                    TransferProposal.write(props, {'state': 'Approved'})
+            else:
+                def approve(props):
+                    outcomes = TransferProposal.approve_all(props)
+                    results['failed'] = len([e for _, e in outcomes if e])
+            results[mode] = timed(approve, props)
+        transaction.rollback()
+    results['speedup'] = results['single'] / results['grouped']
+    return results
+
+
+def generate(companies=2, employees=500, years=2, attendance_days=20, seed=0, start_year=2016):
+    '''
+    Create a deterministic data set: for each company a department tree,
+    its employees with their managers, monthly payroll calendars, the
+    attendance of the first working days of each year, one leave application
+    in review per employee and year and a transfer proposal for a tenth of
+    the employees
+    '''
+    pool = Pool()
+    Department = pool.get('company.department')
+    Party = pool.get('party.party')
+    Employee = pool.get('company.employee')
+    PayrollYear = pool.get('payroll.year')
+    Attendance = pool.get('employee.attendance')
+    LeaveApplication = pool.get('employee.leave.application')
+    TransferProposal = pool.get('employee.transfer.proposal')
+    rng = random.Random(seed)
+    data = {'companies': [], 'employees': [], 'applications': [], 'proposals': []}
+
+    for c in range(companies):
+        company = create_company(name='Company %s' % c)
+        data['companies'].append(company)
+        with set_company(company):
+            root, = Department.create([{'name': 'Head Office %s' % c, 'company': company.id}])
+            branches = Department.create([{'name': 'Branch %s.%s' % (c, b), 'company': company.id,
+                            'parent': root.id} for b in range(4)])
+            teams = Department.create([{'name': 'Team %s.%s.%s' % (c, b.id, t), 'company': company.id,
+                            'parent': b.id} for b in branches for t in range(3)])
+            for y in range(years):
+                PayrollYear.generate([root] + branches + teams, 'monthly',
+                    datetime.date(start_year + y, 1, 1), datetime.date(start_year + y, 12, 31))
+
+            parties = Party.create([{'name': 'Employee %s.%s' % (c, i)} for i in range(employees)])
+            values = []
+            for i, party in enumerate(parties):
+                values.append({
+                        'party': party.id,
+                        'company': company.id,
+                        'department': teams[i % len(teams)].id,
+                        'employee_id': 'C%02dE%06d' % (c, i),
+                        'first_name': 'First%s' % rng.randint(0, 999),
+                        'last_name': 'Last%s' % rng.randint(0, 9999),
+                        'date_of_birth': datetime.date(1960, 1, 1) + datetime.timedelta(rng.randint(0, 14000)),
+                        'types': rng.choice(['probation', 'confirmed']),
+                        })
+            # The first employee of each team manages the others
+            heads = Employee.create(values[:len(teams)])
+            for i, values_ in enumerate(values[len(teams):], len(teams)):
+                values_['manager'] = heads[i % len(teams)].id
+            staff = heads + Employee.create(values[len(teams):])
+            data['employees'].extend(staff)
+
+            for y in range(years):
+                days = [d for d in (datetime.date(start_year + y, 1, 1) + datetime.timedelta(n) for n in range(60))
+                    if d.weekday() < 5][:attendance_days]
+                vlist = []
+                for employee in staff:
+                    for day in days:
+                        in_time = datetime.datetime.combine(day, datetime.time(8)) \
+                            + datetime.timedelta(minutes=rng.randint(0, 90))
+                        vlist.append({
+                                'employee': employee.id,
+                                'date': day,
+                                'in_time': in_time,
+                                'out_time': in_time + datetime.timedelta(hours=8, minutes=rng.randint(-60, 60)),
+                                })
+                for sub_vlist in (vlist[i:i + 5000] for i in range(0, len(vlist), 5000)):
+                    Attendance.create(sub_vlist)
+                data['applications'].extend(LeaveApplication.create([{
+                                'employee': employee.id,
+                                'from_date': datetime.date(start_year + y, 12, 1 + i % 20),
+                                'to_date': datetime.date(start_year + y, 12, 3 + i % 20),
+                                'leave_type': rng.choice(['casual', 'Sick', 'earned']),
+                                'state': 'In Review',
+                                } for i, employee in enumerate(staff)]))
+            data['proposals'].extend(TransferProposal.create([{
+                            'employee': employee.id,
+                            'proposed_company': company.id,
+                            'proposed_department': rng.choice(teams).id,
+                            'proposed_allowance': 0,
+                            'proposed_doj': datetime.date(start_year + years, 1, 1),
+                            'state': 'In Review',
+                            } for employee in staff[::10]]))
+    return data
+
+
+def benchmark_suite(data, start_year=2016, years=2):
+    '''
+    Time the key paths of the module over the generated data and count
+    their queries
+    '''
+    pool = Pool()
+    Employee = pool.get('company.employee')
+    EmployeeHistory = pool.get('company.employee.history')
+    Attendance = pool.get('employee.attendance')
+    LeaveApplication = pool.get('employee.leave.application')
+    TransferProposal = pool.get('employee.transfer.proposal')
+    PayrollYear = pool.get('payroll.year')
+    Department = pool.get('company.department')
+    results = {}
+    employee_ids = [e.id for e in data['employees']]
+
+    results['employee_list'] = measure(Employee.read, employee_ids,
+        ['rec_name', 'available_cl', 'available_sl', 'available_el', 'available_dl', 'available_pl',
+            'available_al'])
+
+    attendance_ids = [a.id for a in Attendance.search([], limit=10000)]
+    results['attendance_period'] = measure(Attendance.read, attendance_ids, ['period'])
+
+    def history(employee_ids):
+        for employee_id in employee_ids:
+            ids = EmployeeHistory.get_page(employee_id)
+            EmployeeHistory.read(ids, ['date', 'employee_id', 'first_name', 'last_name', 'department'])
+    results['employee_history'] = measure(history, employee_ids[:100])
+
+    results['leave_approve'] = measure(LeaveApplication.approve, data['applications'])
+    results['transfer_approve'] = measure(TransferProposal.approve, data['proposals'])
+
+    years_ = []
+    for company in data['companies']:
+        with set_company(company):
+            departments = Department.search([('company', '=', company.id)])
+            years_.extend(PayrollYear.create([{
+                            'name': str(start_year + years),
+                            'company': company.id,
+                            'department': d.id,
+                            'start_date': datetime.date(start_year + years, 1, 1),
+                            'end_date': datetime.date(start_year + years, 12, 31),
+                            } for d in departments]))
+    results['create_period'] = measure(PayrollYear.create_period, years_)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hr module')
+    parser.add_argument('--companies', type=int, default=2)
+    parser.add_argument('--employees', type=int, default=500, help='per company')
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--attendance-days', type=int, default=20, help='per employee and year')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', action='store_true', help='also run the before/after comparisons')
+    options = parser.parse_args()
+
+    install_module('hr')
+    report = {'parameters': vars(options), 'date': datetime.datetime.now().isoformat()}
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        start = time.time()
+        data = generate(options.companies, options.employees, options.years, options.attendance_days,
+            options.seed)
+        report['generate'] = time.time() - start
+        report['paths'] = benchmark_suite(data, years=options.years)
+        for name, result in sorted(report['paths'].items()):
+            print('%-20s %8.3fs %8d queries' % (name, result['seconds'], result['queries']))
+        transaction.rollback()
+
+        if options.compare:
+            report['comparisons'] = {
+                'leave_approve': benchmark_leave_approve(),
+                'employee_create': benchmark_employee_create(),
+                'transfer_approve': benchmark_transfer_approve(),
+                }
+            print('leave approve: %(single).2fs one by one, %(batch).2fs batched '
+                '(x%(speedup).1f)' % report['comparisons']['leave_approve'])
+            print('employee ids: %(single).2fs one by one, %(block).2fs as a block '
+                '(x%(speedup).1f), create in %(create).2fs' % report['comparisons']['employee_create'])
+            print('transfer approve: %(single).2fs one by one, %(grouped).2fs grouped '
+                '(x%(speedup).1f), %(failed)s failed' % report['comparisons']['transfer_approve'])
+
+    with open(options.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+test_hr
+Test the HR workflows
+:copyright: 2017 by Amine Tedjini &amp; Consulting (P) Limited
+:license: BSD, see LICENSE for more details.
+'''
+import datetime
+import unittest
+
+from dateutil.relativedelta import relativedelta
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import with_transaction
+from trytond.modules.company.tests import create_company, set_company
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.modules.hr.attendance import count_violations
+
+from .tools import create_calendar
+
+
+def create_employee(company, department, employee_id='E000001'):
+    '''
+    Create an employee in the department
+    '''
+    pool = Pool()
+    Party = pool.get('party.party')
+    Employee = pool.get('company.employee')
+    party, = Party.create([{'name': 'Employee %s' % employee_id}])
+    employee, = Employee.create([{
+                'party': party.id,
+                'company': company.id,
+                'department': department.id,
+                'employee_id': employee_id,
+                'first_name': 'First',
+                'last_name': 'Last',
+                }])
+    return employee
+
+
+class HRTestCase(unittest.TestCase):
+    '''
+       Test the HR workflows
+    '''
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('hr')
+
+    @with_transaction()
+    def test0010leave_approve_revert(self):
+        '''
+        Test approving then reverting a leave application.
+        '''
+        pool = Pool()
+        Department = pool.get('company.department')
+        Employee = pool.get('company.employee')
+        Attendance = pool.get('employee.attendance')
+        LeaveApplication = pool.get('employee.leave.application')
+        LeaveLedger = pool.get('employee.leave.ledger')
+
+        company = create_company()
+        with set_company(company):
+            department, = Department.create([{'name': 'Department', 'company': company.id}])
+            payroll_year = create_calendar(company, department)
+            employee = create_employee(company, department)
+            app, = LeaveApplication.create([{
+                        'employee': employee.id,
+                        'from_date': datetime.date(2017, 3, 6),
+                        'to_date': datetime.date(2017, 3, 9),
+                        'leave_type': 'casual',
+                        'state': 'In Review',
+                        }])
+            employee_years = {employee.id: payroll_year.id}
+
+            LeaveApplication.approve([app])
+            app = LeaveApplication(app.id)
+            self.assertEqual(app.state, 'Approved')
+            self.assertEqual(Attendance.search([('leave_application', '=', app.id)], count=True), 4)
+            self.assertEqual(LeaveLedger.get_taken(employee_years), {(employee.id, 'casual'): 4})
+
+            # The leave taken follows the employee to a department of the same calendar
+            other, = Department.create([{'name': 'Other', 'company': company.id}])
+            other_year = create_calendar(company, other)
+            Employee.write([employee], {'department': other.id})
+            employee_years = {employee.id: other_year.id}
+            self.assertEqual(LeaveLedger.get_taken(employee_years), {(employee.id, 'casual'): 4})
+
+            LeaveApplication.revert([app])
+            app = LeaveApplication(app.id)
+            self.assertEqual(app.state, 'Draft')
+            self.assertEqual(Attendance.search([('leave_application', '=', app.id)], count=True), 0)
+            self.assertEqual(LeaveLedger.get_taken(employee_years), {(employee.id, 'casual'): 0})
+            self.assertEqual(LeaveLedger.search([('taken', '<', 0)]), [])
+
+            # A leave of one day
+            one_day, = LeaveApplication.create([{
+                        'employee': employee.id,
+                        'from_date': datetime.date(2017, 3, 13),
+                        'to_date': datetime.date(2017, 3, 13),
+                        'leave_type': 'casual',
+                        'state': 'In Review',
+                        }])
+            LeaveApplication.approve([one_day])
+            self.assertEqual(LeaveLedger.get_taken(employee_years), {(employee.id, 'casual'): 1})
+
+    @with_transaction()
+    def test0020transfer_approve_all(self):
+        '''
+        Test approving a group of transfers with one failing employee.
+        '''
+        pool = Pool()
+        Department = pool.get('company.department')
+        Employee = pool.get('company.employee')
+        TransferProposal = pool.get('employee.transfer.proposal')
+
+        company = create_company()
+        with set_company(company):
+            source, target = Department.create([{'name': 'Source', 'company': company.id},
+                                                {'name': 'Target', 'company': company.id}])
+            employees = [create_employee(company, source, 'E%06d' % i) for i in range(3)]
+            proposals = TransferProposal.create([{
+                        'employee': employee.id,
+                        'proposed_company': company.id,
+                        'proposed_department': target.id,
+                        'proposed_allowance': 0,
+                        'proposed_doj': datetime.date(2017, 1, 1),
+                        'state': 'In Review',
+                        } for employee in employees])
+            failing = employees[1]
+
+            write = Employee.write.__func__
+
+            def refuse(error):
+                def refusing_write(cls, *args):
+                    if any(failing in records for records in args[::2]):
+                        raise error
+                    return write(cls, *args)
+                return classmethod(refusing_write)
+
+            Employee.write = refuse(UserError('Refused'))
+            try:
+                outcomes = TransferProposal.approve_all(proposals)
+            finally:
+                Employee.write = classmethod(write)
+            self.assertEqual(outcomes, [(proposals[0].id, None), (proposals[1].id, 'Refused'),
+                                        (proposals[2].id, None)])
+            self.assertEqual([p.state for p in TransferProposal.browse(proposals)],
+                             ['Approved', 'In Review', 'Approved'])
+            self.assertEqual([e.department for e in Employee.browse(employees)], [target, source, target])
+
+            # Other errors are not approval failures, nothing is transferred
+            TransferProposal.write([proposals[0], proposals[2]], {'state': 'In Review'})
+            Employee.write(employees, {'department': source.id})
+            Employee.write = refuse(ValueError('Broken'))
+            try:
+                self.assertRaises(ValueError, TransferProposal.approve_all, proposals)
+            finally:
+                Employee.write = classmethod(write)
+            self.assertEqual([e.department for e in Employee.browse(employees)], [source] * 3)
+
+    @with_transaction()
+    def test0030reorganize(self):
+        '''
+        Test reorganizing a department subtree.
+        '''
+        pool = Pool()
+        Department = pool.get('company.department')
+        Employee = pool.get('company.employee')
+        PayrollYear = pool.get('payroll.year')
+        PayrollPeriod = pool.get('payroll.period')
+        ReorganizeLine = pool.get('company.department.reorganize.line')
+        Reorganize = pool.get('company.department.reorganize', type='wizard')
+
+        company = create_company()
+        with set_company(company):
+            root, = Department.create([{'name': 'Root', 'company': company.id}])
+            source, target, other = Department.create([{'name': name, 'company': company.id, 'parent': root.id}
+                    for name in ('Source', 'Target', 'Other')])
+            child, = Department.create([{'name': 'Child', 'company': company.id, 'parent': source.id}])
+            payroll_year = create_calendar(company, source)
+            source_employee = create_employee(company, source, 'E000001')
+            child_employee = create_employee(company, child, 'E000002')
+
+            session_id, _, _ = Reorganize.create()
+            reorganize = Reorganize(session_id)
+            reorganize.start.source = source
+            reorganize.start.target = target
+            reorganize.start.lines = [ReorganizeLine(source=child, target=other)]
+            reorganize.start.deactivate = True
+            reorganize.transition_reorganize()
+
+            self.assertEqual(Employee(source_employee.id).department, target)
+            self.assertEqual(Employee(child_employee.id).department, other)
+            self.assertEqual(PayrollYear(payroll_year.id).department, target)
+            self.assertEqual(set(p.department for p in PayrollPeriod.search([
+                                ('payroll_year', '=', payroll_year.id)])), set([target]))
+            self.assertEqual([d.active for d in Department.browse([source, child, target, other])],
+                             [False, False, True, True])
+
+            # The target already has a payroll year of the same dates
+            create_calendar(company, source)
+            self.assertRaises(UserError, Department.reorganize, {source.id: target.id})
+
+    @with_transaction()
+    def test0040leave_entitlements(self):
+        '''
+        Test resolving the leave entitlements from the policies.
+        '''
+        pool = Pool()
+        Department = pool.get('company.department')
+        Employee = pool.get('company.employee')
+        LeavePolicy = pool.get('employee.leave.policy')
+
+        company = create_company()
+        with set_company(company):
+            root, = Department.create([{'name': 'Root', 'company': company.id}])
+            branch, = Department.create([{'name': 'Branch', 'company': company.id, 'parent': root.id}])
+            team, = Department.create([{'name': 'Team', 'company': company.id, 'parent': branch.id}])
+            employee = create_employee(company, team)
+            Employee.write([employee], {'types': 'confirmed'})
+            LeavePolicy.create([{
+                        'company': company.id,
+                        'department': department.id,
+                        'employee_type': employee_type,
+                        'leave_type': 'casual',
+                        'entitlement': entitlement,
+                        } for department, employee_type, entitlement in [
+                        (root, None, 12),
+                        (branch, None, 13),
+                        (branch, 'confirmed', 14),
+                        (team, 'probation', 20),
+                        ]])
+
+            # The nearest department with a policy wins, its employee type first
+            self.assertEqual(LeavePolicy.get_entitlements([employee], ['casual', 'Sick']),
+                             {(employee.id, 'casual'): 14, (employee.id, 'Sick'): 10})
+            Employee.write([employee], {'types': 'probation'})
+            self.assertEqual(LeavePolicy.get_entitlements([Employee(employee.id)], ['casual']),
+                             {(employee.id, 'casual'): 20})
+
+            # A company policy for any type replaces the configuration
+            LeavePolicy.create([{
+                        'company': company.id,
+                        'leave_type': 'Sick',
+                        'entitlement': 7,
+                        }])
+            self.assertEqual(LeavePolicy.get_entitlements([Employee(employee.id)], ['Sick']),
+                             {(employee.id, 'Sick'): 7})
+
+            # Any employee type of the department is unique too
+            self.assertRaises(UserError, LeavePolicy.create, [{
+                        'company': company.id,
+                        'department': branch.id,
+                        'leave_type': 'casual',
+                        'entitlement': 1,
+                        }])
+
+    @with_transaction()
+    def test0050period_delete(self):
+        '''
+        Test the attendance periods after deleting a payroll period.
+        '''
+        pool = Pool()
+        Department = pool.get('company.department')
+        Attendance = pool.get('employee.attendance')
+        PayrollPeriod = pool.get('payroll.period')
+        Holiday = pool.get('payroll.holiday')
+
+        company = create_company()
+        with set_company(company):
+            department, = Department.create([{'name': 'Department', 'company': company.id}])
+            payroll_year = create_calendar(company, department)
+            employee = create_employee(company, department)
+            attendance, = Attendance.create([{'employee': employee.id, 'date': datetime.date(2017, 3, 6)}])
+            period, = PayrollPeriod.search([
+                    ('payroll_year', '=', payroll_year.id),
+                    ('start_date', '<=', attendance.date),
+                    ('end_date', '>=', attendance.date),
+                    ])
+            holiday, = Holiday.create([{'period': period.id, 'date': attendance.date}])
+
+            attendance = Attendance(attendance.id)
+            self.assertEqual(attendance.period, period)
+            self.assertTrue(attendance.is_holiday)
+
+            Holiday.delete([holiday])
+            PayrollPeriod.delete([period])
+            attendance = Attendance(attendance.id)
+            self.assertEqual(attendance.period, None)
+            self.assertFalse(attendance.is_holiday)
+            self.assertEqual(Attendance.search([('period', '=', None)]), [attendance])
+
+    @with_transaction()
+    def test0060search_rec_name(self):
+        '''
+        Test searching the employees by id, names and party name.
+        '''
+        pool = Pool()
+        Department = pool.get('company.department')
+        Employee = pool.get('company.employee')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            department, = Department.create([{'name': 'Department', 'company': company.id}])
+            employee = create_employee(company, department, 'E000042')
+
+            self.assertEqual(Employee.search([('rec_name', 'ilike', '%E000042%')]), [employee])
+            self.assertEqual(Employee.search([('rec_name', 'ilike', '%first last%')]), [employee])
+            self.assertEqual(Employee.search([('rec_name', 'ilike', '%employee e000042%')]), [employee])
+
+            Party.write([employee.party], {'name': 'Jane Smith'})
+            self.assertEqual(Employee.search([('rec_name', 'ilike', '%smith%')]), [employee])
+            self.assertEqual(Employee.search([('rec_name', 'ilike', '%employee e000042%')]), [])
+
+    @with_transaction()
+    def test0070age(self):
+        '''
+        Test searching and ordering the employees by age.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Department = pool.get('company.department')
+        Employee = pool.get('company.employee')
+
+        company = create_company()
+        with set_company(company):
+            today = Date.today()
+            department, = Department.create([{'name': 'Department', 'company': company.id}])
+            young, old, unknown = [create_employee(company, department, 'E%06d' % i) for i in range(3)]
+            Employee.write([young], {'date_of_birth': today - relativedelta(years=30, days=10)},
+                [old], {'date_of_birth': today - relativedelta(years=40)})
+            ids = [young.id, old.id, unknown.id]
+
+            def search(clause):
+                return Employee.search([('id', 'in', ids), clause])
+            self.assertEqual(search(('age', '=', 30)), [young])
+            self.assertEqual(search(('age', 'ilike', '%30%')), [young])
+            self.assertEqual(search(('age', '>=', 40)), [old])
+            self.assertEqual(search(('age', '<', 40)), [young])
+            self.assertEqual(search(('age', '=', None)), [unknown])
+            self.assertEqual(search(('age', 'ilike', '%abc%')), [])
+
+            self.assertEqual(Employee.search([('id', 'in', [young.id, old.id])], order=[('age', 'ASC')]),
+                             [young, old])
+            self.assertEqual(Employee.search([('id', 'in', [young.id, old.id])], order=[('age', 'DESC')]),
+                             [old, young])
+
+    @with_transaction()
+    def test0080period_without_department(self):
+        '''
+        Test the attendance of an employee without department has no period.
+        '''
+        pool = Pool()
+        Department = pool.get('company.department')
+        Employee = pool.get('company.employee')
+        Attendance = pool.get('employee.attendance')
+
+        company = create_company()
+        with set_company(company):
+            department, = Department.create([{'name': 'Department', 'company': company.id}])
+            create_calendar(company, department)
+            employee = create_employee(company, department)
+            Employee.write([employee], {'department': None})
+            attendance, = Attendance.create([{'employee': employee.id, 'date': datetime.date(2017, 3, 6)}])
+
+            self.assertEqual(Attendance(attendance.id).period, None)
+            self.assertEqual(Attendance.search([('id', '=', attendance.id), ('period', '=', None)]),
+                             [attendance])
+            self.assertEqual(Attendance.search([('id', '=', attendance.id), ('period', '!=', None)]), [])
+
+    @with_transaction()
+    def test0090search_managers(self):
+        '''
+        Test searching the employees by their managers.
+        '''
+        pool = Pool()
+        Department = pool.get('company.department')
+        Employee = pool.get('company.employee')
+
+        company = create_company()
+        with set_company(company):
+            department, = Department.create([{'name': 'Department', 'company': company.id}])
+            head, manager, report = [create_employee(company, department, 'E%06d' % i) for i in range(3)]
+            Employee.write([manager], {'manager': head.id}, [report], {'manager': manager.id})
+            ids = [head.id, manager.id, report.id]
+
+            def search(clause):
+                return Employee.search([('id', 'in', ids), clause], order=[('employee_id', 'ASC')])
+            self.assertEqual(search(('managers', '=', head.id)), [manager, report])
+            self.assertEqual(search(('managers', 'in', [manager.id])), [report])
+            self.assertEqual(search(('managers', 'not in', [manager.id])), [head, manager])
+            self.assertEqual(search(('managers', '=', None)), [head])
+            self.assertEqual(search(('managers', '!=', None)), [manager, report])
+            self.assertEqual(search(('managers', 'ilike', '%E000001%')), [report])
+            self.assertEqual(search(('managers.employee_id', '=', 'E000000')), [manager, report])
+            self.assertEqual(Employee(report.id).managers, (manager, head))
+            self.assertEqual(Employee(head.id).span_of_control, 1)
+
+    @with_transaction()
+    def test0100generate_calendar(self):
+        '''
+        Test generating the payroll calendars of departments from a template.
+        '''
+        pool = Pool()
+        Department = pool.get('company.department')
+        PayrollYear = pool.get('payroll.year')
+        PayrollPeriod = pool.get('payroll.period')
+
+        company = create_company()
+        with set_company(company):
+            departments = Department.create([{'name': 'Department %s' % i, 'company': company.id}
+                    for i in range(2)])
+            years = PayrollYear.generate(departments, 'semi_monthly',
+                datetime.date(2017, 1, 1), datetime.date(2017, 12, 31))
+            self.assertEqual(sorted(y.department.id for y in years), sorted(d.id for d in departments))
+            for year in years:
+                self.assertEqual(year.name, '2017')
+                periods = PayrollPeriod.search([('payroll_year', '=', year.id)], order=[('start_date', 'ASC')])
+                self.assertEqual(len(periods), 24)
+                self.assertEqual([(p.start_date, p.end_date) for p in periods[:2]],
+                    [(datetime.date(2017, 1, 1), datetime.date(2017, 1, 15)),
+                        (datetime.date(2017, 1, 16), datetime.date(2017, 1, 31))])
+                self.assertEqual(periods[-1].end_date, datetime.date(2017, 12, 31))
+                self.assertEqual(PayrollPeriod.find(company.id, year.department.id, datetime.date(2017, 1, 20)),
+                    periods[1].id)
+
+            years = PayrollYear.generate(departments[:1], 'weekly',
+                datetime.date(2018, 1, 1), datetime.date(2018, 12, 31))
+            periods = PayrollPeriod.search([('payroll_year', '=', years[0].id)], order=[('start_date', 'ASC')])
+            self.assertEqual(len(periods), 53)
+            self.assertEqual((periods[0].start_date, periods[0].end_date),
+                (datetime.date(2018, 1, 1), datetime.date(2018, 1, 7)))
+            self.assertEqual((periods[-1].start_date, periods[-1].end_date),
+                (datetime.date(2018, 12, 31), datetime.date(2018, 12, 31)))
+
+            # A year overlapping one of the department is refused
+            self.assertRaises(UserError, PayrollYear.generate, departments, 'monthly',
+                datetime.date(2018, 6, 1), datetime.date(2019, 5, 31))
+
+    @with_transaction()
+    def test0110department_tree(self):
+        '''
+        Test the department paths, subtrees, reparenting and headcount.
+        '''
+        pool = Pool()
+        Department = pool.get('company.department')
+        Employee = pool.get('company.employee')
+
+        company = create_company()
+        with set_company(company):
+            root, other = Department.create([{'name': name, 'company': company.id}
+                    for name in ('Root', 'Other')])
+            child, = Department.create([{'name': 'Child', 'company': company.id, 'parent': root.id}])
+            grandchild, = Department.create([{'name': 'Grandchild', 'company': company.id, 'parent': child.id}])
+            create_employee(company, root, 'E000001')
+            deep = create_employee(company, grandchild, 'E000002')
+
+            def paths():
+                return dict((d['id'], d['path']) for d in Department.read(
+                            [root.id, other.id, child.id, grandchild.id], ['path']))
+
+            def headcounts():
+                return dict((d['id'], d['headcount']) for d in Department.read(
+                            [root.id, other.id, child.id, grandchild.id], ['headcount']))
+            self.assertEqual(paths()[grandchild.id], '/%s/%s/%s/' % (root.id, child.id, grandchild.id))
+            self.assertEqual(Employee.search(Department.subtree_domain([Department(child.id)])), [deep])
+            self.assertEqual(headcounts(), {root.id: 2, other.id: 0, child.id: 1, grandchild.id: 1})
+
+            Department.reparent([child], other)
+            self.assertEqual(paths()[child.id], '/%s/%s/' % (other.id, child.id))
+            self.assertEqual(paths()[grandchild.id], '/%s/%s/%s/' % (other.id, child.id, grandchild.id))
+            self.assertEqual(headcounts(), {root.id: 1, other.id: 1, child.id: 1, grandchild.id: 1})
+
+            # A department can not be moved under its own subtree
+            self.assertRaises(UserError, Department.reparent, [other], Department(grandchild.id))
+
+    @with_transaction()
+    def test0120punctuality(self):
+        '''
+        Test the monthly punctuality evaluation with inherited thresholds.
+        '''
+        pool = Pool()
+        Department = pool.get('company.department')
+        Attendance = pool.get('employee.attendance')
+        Punctuality = pool.get('employee.punctuality')
+
+        company = create_company()
+        with set_company(company):
+            root, = Department.create([{
+                        'name': 'Root',
+                        'company': company.id,
+                        'late_coming_time': datetime.time(9),
+                        'allowed_late_comings': 1,
+                        'early_departure_time': datetime.time(17),
+                        'allowed_early_departures': 0,
+                        }])
+            child, = Department.create([{
+                        'name': 'Child',
+                        'company': company.id,
+                        'parent': root.id,
+                        'allowed_late_comings': 3,
+                        'allowed_early_departures': None,
+                        }])
+            employee = create_employee(company, child)
+            vlist = []
+            for day, in_, out in [(1, (9, 30), (17, 30)), (2, (9, 15), (16, 0)), (3, (8, 50), (17, 10)),
+                    (6, (10, 0), (15, 0))]:
+                date = datetime.date(2017, 3, day)
+                vlist.append({
+                        'employee': employee.id,
+                        'date': date,
+                        'in_time': datetime.datetime.combine(date, datetime.time(*in_)),
+                        'out_time': datetime.datetime.combine(date, datetime.time(*out)),
+                        })
+            # An attendance of another month is not evaluated
+            vlist.append({
+                    'employee': employee.id,
+                    'date': datetime.date(2017, 4, 3),
+                    'in_time': datetime.datetime(2017, 4, 3, 11),
+                    })
+            Attendance.create(vlist)
+
+            Punctuality.evaluate(company.id, datetime.date(2017, 3, 15))
+            punctuality, = Punctuality.search([('employee', '=', employee.id)])
+            self.assertEqual(punctuality.month, datetime.date(2017, 3, 1))
+            self.assertEqual(punctuality.department, child)
+            self.assertEqual((punctuality.late_comings, punctuality.allowed_late_comings,
+                    punctuality.excess_late_comings), (3, 3, 0))
+            self.assertEqual((punctuality.early_departures, punctuality.allowed_early_departures,
+                    punctuality.excess_early_departures), (2, 0, 2))
+
+            # A new evaluation replaces the former one
+            Punctuality.evaluate(company.id, datetime.date(2017, 3, 1))
+            self.assertEqual(len(Punctuality.search([('employee', '=', employee.id)])), 1)
+
+        # Punches at midnight carry no time and are not counted
+        midnight = datetime.datetime(2017, 3, 1)
+        policies = {1: {'early_departure_time': datetime.time(9)}}
+        self.assertEqual(count_violations([(1, 1, midnight, midnight), (1, 1, midnight, None)], policies),
+            {1: [1, 0, 0]})
+
+
+def suite():
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(HRTestCase))
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
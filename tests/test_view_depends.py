@@ -10,8 +10,8 @@ import sys
 import os
 
 DIR = os.path.abspath(os.path.normpath(os.path.join(__file__, '..', '..', '..', '..', '..', 'trytond')))
-    if os.path.isdir(DIR):
-        sys.path.insert(0, os.path.dirname(DIR))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
 
 import unittest
 import trytond.tests.test_tryton
@@ -41,10 +41,11 @@ class TestViewDependsCase(unittest.TestCase):
         test_depends()
 
 
-    def suite():
-        test_suite = trytond.tests.test_tryton.suite()
-        test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestViewDependsCase)
-        return test_suite
-        if __name__ == '__main__':
-            unittest.TextTestRunner(verbosity=2).run(suite()
+def suite():
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestViewDependsCase))
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
 
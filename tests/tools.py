@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+'''
+tools
+Helpers shared by the tests and the benchmarks of the HR module
+:copyright: 2017 by Amine Tedjini &amp; Consulting (P) Limited
+:license: BSD, see LICENSE for more details.
+'''
+import datetime
+
+from trytond.pool import Pool
+
+
+def create_calendar(company, department, year=2017):
+    '''
+    Create an open payroll year with monthly periods for the department
+    '''
+    PayrollYear = Pool().get('payroll.year')
+    payroll_year, = PayrollYear.create([{
+                'name': str(year),
+                'company': company.id,
+                'department': department.id,
+                'start_date': datetime.date(year, 1, 1),
+                'end_date': datetime.date(year, 12, 31),
+                }])
+    PayrollYear.create_period([payroll_year])
+    return payroll_year